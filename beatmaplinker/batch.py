@@ -0,0 +1,231 @@
+import gzip
+import html
+import json
+import re
+import urllib.parse
+from collections import deque
+
+import praw
+
+from .cache import PAGE_SIZE
+
+# Markdown links, and bare URLs which reddit turns into links. Punctuation
+# ending a sentence isn't part of a bare URL.
+MARKDOWN_LINK_REGEX = re.compile(
+    r'\[(?P<label>[^\]]*)\]\((?P<href>[^)\s]+)\)'
+    r'|(?P<bare>https?://[^\s\[\]()<>"]*[^\s\[\]()<>".,;:!?])')
+# Request parameters which don't change the response: the API key, and how
+# long Tillerino may wait to compute pp.
+IGNORED_PARAMS = {"k", "wait"}
+
+# The function pool workers call, inherited when they're forked.
+_worker = None
+
+
+class MissingResponse(Exception):
+    """Raised when replaying a request which was never recorded."""
+
+
+def read_dump(path):
+    """Yields the lines of a dump of reddit things, one JSON object per
+    line, skipping blank lines. Dumps ending in .gz are gzipped."""
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, "rt", encoding="utf8") as f:
+        for line in f:
+            if line.strip():
+                yield line
+
+
+def make_thing(record):
+    """Returns the thing type and a praw Comment or Submission of a dumped
+    thing, without a reddit instance.
+
+    Dumps which only have the markdown of a thing get HTML made from its
+    links, the way reddit would render them.
+    """
+    if record.get("name", "").startswith("t3_") or "title" in record:
+        raw_html = record.get("selftext_html")
+        if raw_html is None and record.get("selftext"):
+            raw_html = markdown_to_raw_html(record["selftext"])
+        return "submission", praw.models.Submission(None, _data={
+            "id": record["id"],
+            "selftext_html": raw_html,
+            "created_utc": record.get("created_utc", 0)
+        })
+    raw_html = record.get("body_html")
+    if raw_html is None:
+        raw_html = markdown_to_raw_html(record.get("body", ""))
+    return "comment", praw.models.Comment(None, _data={
+        "id": record["id"],
+        "body_html": raw_html,
+        "created_utc": record.get("created_utc", 0)
+    })
+
+
+def markdown_to_raw_html(text):
+    """Returns HTML with the links in reddit markdown, escaped as reddit
+    sends it. Reddit escapes &, < and > in markdown too."""
+    text = html.unescape(text)
+    parts = []
+    last = 0
+    for match in MARKDOWN_LINK_REGEX.finditer(text):
+        href = match.group("href") or match.group("bare")
+        label = href if match.group("bare") else match.group("label")
+        parts.append(html.escape(text[last:match.start()], quote=False))
+        parts.append('<a href="{}">{}</a>'.format(html.escape(href),
+                                                 html.escape(label,
+                                                             quote=False)))
+        last = match.end()
+    parts.append(html.escape(text[last:], quote=False))
+    return html.escape('<div class="md">' + "".join(parts) + "</div>",
+                       quote=False)
+
+
+def fullname(thing):
+    if isinstance(thing, praw.models.Submission):
+        return "t3_" + thing.id
+    return "t1_" + thing.id
+
+
+class BatchReddit:
+    """Stands in for Reddit in batch runs, keeping a record of each reply
+    instead of posting it.
+
+    With a reply ledger, things the bot replied to are skipped.
+    """
+    def __init__(self, ledger=None):
+        self.ledger = ledger
+        self.records = []
+
+    def has_replied(self, thing):
+        return self.ledger is not None and fullname(thing) in self.ledger
+
+    def reply(self, thing, texts):
+        self.records.append({"id": thing.id, "fullname": fullname(thing),
+                             "comments": list(texts)})
+        return True
+
+
+class ResponseStore:
+    """API responses recorded in a database, to replay offline."""
+    def __init__(self, db):
+        self.db = db
+        self.db.execute("CREATE TABLE IF NOT EXISTS responses ("
+                        "api TEXT NOT NULL, "
+                        "request TEXT NOT NULL, "
+                        "status INTEGER NOT NULL, "
+                        "body TEXT NOT NULL, "
+                        "PRIMARY KEY (api, request))")
+
+    def get(self, api, params):
+        """Returns the (status, body) recorded for a request, or None."""
+        rows = self.db.execute("SELECT status, body FROM responses "
+                               "WHERE api = ? AND request = ?",
+                               (api, request_key(params)))
+        return rows[0] if rows else None
+
+    def iter_responses(self, api):
+        """Yields (params, status, body) for every response recorded from an
+        API, reading a page at a time."""
+        last = ""
+        while True:
+            rows = self.db.execute("SELECT request, status, body "
+                                   "FROM responses WHERE api = ? "
+                                   "AND request > ? ORDER BY request LIMIT ?",
+                                   (api, last, PAGE_SIZE))
+            for request, status, body in rows:
+                yield dict(urllib.parse.parse_qsl(request)), status, body
+            if len(rows) < PAGE_SIZE:
+                return
+            last = rows[-1][0]
+
+    def put(self, api, params, status, body):
+        self.db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                        (api, request_key(params), status, body))
+
+
+def request_key(params):
+    return urllib.parse.urlencode(sorted(
+        (k, str(v)) for k, v in params.items() if k not in IGNORED_PARAMS))
+
+
+class RecordedResponse:
+    def __init__(self, status_code, text):
+        self.status_code = status_code
+        self.text = text
+
+    def json(self):
+        return json.loads(self.text)
+
+
+class RecordedSession:
+    """Stands in for an API wrapper's Session, answering from a
+    ResponseStore.
+
+    Given the wrapper's session, requests go to the API and their responses
+    are recorded, except server errors. Otherwise requests which weren't
+    recorded raise MissingResponse.
+    """
+    def __init__(self, store, api, session=None):
+        self.store = store
+        self.api = api
+        self.session = session
+
+    def get(self, url, within=None, **kwargs):
+        params = kwargs.get("params", {})
+        if self.session is not None:
+            r = self.session.get(url, within, **kwargs)
+            if r.status_code < 500:
+                self.store.put(self.api, params, r.status_code, r.text)
+            return r
+        recorded = self.store.get(self.api, params)
+        if recorded is None:
+            raise MissingResponse("no {} response recorded for {}".format(
+                self.api, request_key(params)))
+        return RecordedResponse(*recorded)
+
+    def shortened(self, within):
+        # Failing to replay a request says nothing about the API.
+        if self.session is None:
+            return True
+        return self.session.shortened(within)
+
+    def stats(self):
+        if self.session is not None:
+            return self.session.stats()
+        return {"sessions": 0, "requests": 0, "connections_opened": 0,
+                "connections_reused": 0}
+
+
+def init_worker(func):
+    global _worker
+    _worker = func
+
+
+def run_worker(item):
+    return _worker(item)
+
+
+def windowed(submit, items, window):
+    """Yields the results of submit(item) futures in order, with at most
+    window of them pending, so items are read only as fast as they're
+    processed."""
+    pending = deque()
+    for item in items:
+        pending.append(submit(item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def chunks(iterable, size):
+    """Yields lists of up to size items of iterable."""
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
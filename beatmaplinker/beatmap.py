@@ -0,0 +1,116 @@
+from operator import attrgetter
+
+# Fields of get_beatmaps responses kept for every difficulty.
+FIELDS = ("beatmap_id", "beatmapset_id", "approved", "mode", "artist", "title",
+          "version", "creator", "creator_id", "difficultyrating", "diff_size",
+          "diff_approach", "diff_overall", "diff_drain", "hit_length",
+          "total_length", "bpm", "last_update")
+get_fields = attrgetter(*FIELDS)
+# Fields of get_beatmaps responses parsed into numbers once, when read.
+FLOAT_FIELDS = {"difficultyrating"}
+INT_FIELDS = {"hit_length", "total_length"}
+# Fields every difficulty of a set has in common, shared between them.
+SET_FIELDS = ("beatmapset_id", "approved", "artist", "title", "creator",
+              "creator_id", "last_update")
+
+
+class Beatmap:
+    """A difficulty from a get_beatmaps response.
+
+    Only the fields the bot and the default templates use are kept, with
+    numeric fields parsed. Any other fields the templates use are kept in
+    extras.
+    """
+    __slots__ = FIELDS + ("extras",)
+
+    @classmethod
+    def from_dict(cls, d, extra_fields=()):
+        """Makes a Beatmap from a difficulty of a get_beatmaps response, or
+        from what to_dict returned."""
+        beatmap = cls()
+        for field in FIELDS:
+            value = d[field]
+            if field in FLOAT_FIELDS:
+                value = float(value)
+            elif field in INT_FIELDS:
+                value = int(value)
+            setattr(beatmap, field, value)
+        beatmap.extras = {field: d[field] for field in extra_fields
+                          if field in d}
+        return beatmap
+
+    def to_dict(self):
+        """Returns a new dict of the fields, as the templates are formatted
+        with."""
+        out = dict(zip(FIELDS, get_fields(self)))
+        out.update(self.extras)
+        return out
+
+
+class Mapset:
+    """The difficulties of a get_beatmaps response, grouped by mode.
+
+    The set's info is taken from first, the first difficulty of the response.
+    A Mapset without difficulties is a map which doesn't exist.
+    """
+    __slots__ = ("first", "modes", "count")
+
+    def __init__(self, beatmaps=()):
+        self.first = beatmaps[0] if beatmaps else None
+        self.count = len(beatmaps)
+        modes = {}
+        for beatmap in beatmaps:
+            if beatmap is not self.first:
+                for field in SET_FIELDS:
+                    value = getattr(self.first, field)
+                    if getattr(beatmap, field) == value:
+                        setattr(beatmap, field, value)
+            modes.setdefault(beatmap.mode, []).append(beatmap)
+        self.modes = {mode: tuple(diffs) for mode, diffs in modes.items()}
+
+    @classmethod
+    def from_response(cls, response, extra_fields=()):
+        """Makes a Mapset from a get_beatmaps response, keeping extra_fields
+        of each difficulty as well."""
+        return cls([Beatmap.from_dict(d, extra_fields) for d in response])
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        """Yields the first difficulty, then the rest by mode."""
+        if self.first is not None:
+            yield self.first
+        for diffs in self.modes.values():
+            for beatmap in diffs:
+                if beatmap is not self.first:
+                    yield beatmap
+
+    def difficulty(self, beatmap_id):
+        """Returns a Mapset of the difficulty of an id, which is empty if
+        the set doesn't have it."""
+        return Mapset([beatmap for beatmap in self
+                       if beatmap.beatmap_id == beatmap_id])
+
+    def to_dicts(self):
+        """Returns a JSON serialisable list of the difficulties."""
+        return [beatmap.to_dict() for beatmap in self]
+
+
+def extra_fields(fields):
+    """Returns the fields of fields Beatmap doesn't have slots for."""
+    return tuple(sorted(set(fields).difference(FIELDS)))
+
+
+def decode(dicts, extra_fields=()):
+    """Returns a Mapset of what Mapset.to_dicts returned, or None if the
+    difficulties lack any of extra_fields, as when the templates have
+    changed since."""
+    for d in dicts:
+        if any(field not in d for field in extra_fields):
+            return None
+    return Mapset.from_response(dicts, extra_fields)
+
+
+def encode(mapset):
+    return mapset.to_dicts()
@@ -0,0 +1,272 @@
+import gzip
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+SNAPSHOT_FORMAT = "beatmaplinker-cache"
+SNAPSHOT_VERSION = 1
+# Entries are read from the database and written to it in pages this big.
+PAGE_SIZE = 1000
+
+
+class Cache:
+    """A TTL cache with an in-memory LRU in front of an optional database.
+
+    Keys are tuples of strings and values must be JSON serialisable, unless
+    encode is given to make them so and decode to turn them back. Decoding
+    may return None for values which can't be used any more. Entries written
+    to the database survive restarts of the bot.
+    """
+    def __init__(self, name, maxsize=1024, db=None, encode=None, decode=None):
+        self.name = name
+        self.maxsize = int(maxsize)
+        self.db = db
+        self.encode = encode or identity
+        self.decode = decode or identity
+        self.entries = OrderedDict()  # key -> (expiry time, value)
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.db is not None:
+            self.attach(db)
+
+    def attach(self, db):
+        """Backs the cache with a database, which may be shared with caches
+        in other processes."""
+        db.execute("CREATE TABLE IF NOT EXISTS cache ("
+                   "name TEXT NOT NULL, "
+                   "key TEXT NOT NULL, "
+                   "expires REAL NOT NULL, "
+                   "value TEXT NOT NULL, "
+                   "PRIMARY KEY (name, key))")
+        self.db = db
+
+    def purge(self):
+        """Removes expired entries from the database."""
+        if self.db is not None:
+            self.db.execute("DELETE FROM cache WHERE name = ? AND expires <= ?",
+                            (self.name, time.time()))
+
+    def get(self, key):
+        """Returns the value stored for key, or None if there is none."""
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self.entries[key]
+
+        entry = self._db_get(key, now)
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._store(key, entry)
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Stores value for key for ttl seconds, or forever if ttl is None."""
+        if ttl is None:
+            entry = (float("inf"), value)
+        else:
+            entry = (time.time() + ttl, value)
+        with self.lock:
+            self._store(key, entry)
+        if self.db is not None:
+            self.db.execute("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                            (self.name, db_key(key), entry[0],
+                             json.dumps(self.encode(value))))
+
+    def iter_entries(self):
+        """Yields (key, expiry time, value) for every unexpired entry, with
+        values encoded.
+
+        Entries are read from the database a page at a time, so this takes
+        little memory however big the cache is.
+        """
+        now = time.time()
+        if self.db is None:
+            with self.lock:
+                entries = list(self.entries.items())
+            for key, (expires, value) in entries:
+                if expires > now:
+                    yield key, expires, self.encode(value)
+            return
+
+        last = ""
+        while True:
+            rows = self.db.execute("SELECT key, expires, value FROM cache "
+                                   "WHERE name = ? AND key > ? AND expires > ? "
+                                   "ORDER BY key LIMIT ?",
+                                   (self.name, last, now, PAGE_SIZE))
+            for key, expires, value in rows:
+                yield tuple(key.split(":")), expires, json.loads(value)
+            if len(rows) < PAGE_SIZE:
+                return
+            last = rows[-1][0]
+
+    def load(self, entries):
+        """Stores (key, expiry time, encoded value) entries, skipping expired
+        ones.
+
+        Returns the number of entries stored. With a database, entries only
+        go into memory once they're looked up.
+        """
+        now = time.time()
+        entries = [(tuple(key), expires, value)
+                   for key, expires, value in entries if expires > now]
+        if self.db is None:
+            decoded = [(key, expires, self.decode(value))
+                       for key, expires, value in entries]
+            entries = [entry for entry in decoded if entry[2] is not None]
+            with self.lock:
+                for key, expires, value in entries:
+                    self._store(key, (expires, value))
+        else:
+            self.db.executemany(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                [(self.name, db_key(key), expires, json.dumps(value))
+                 for key, expires, value in entries])
+        return len(entries)
+
+    def stats(self):
+        """Returns a dict of cache counters."""
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self.entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+    def _store(self, key, entry):
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def _db_get(self, key, now):
+        if self.db is None:
+            return None
+        rows = self.db.execute("SELECT expires, value FROM cache "
+                               "WHERE name = ? AND key = ?",
+                               (self.name, db_key(key)))
+        if not rows:
+            return None
+        expires, value = rows[0]
+        if expires <= now:
+            self.db.execute("DELETE FROM cache WHERE name = ? AND key = ?",
+                            (self.name, db_key(key)))
+            return None
+        value = self.decode(json.loads(value))
+        if value is None:
+            return None
+        return expires, value
+
+
+class SingleFlight:
+    """Collapses concurrent calls for the same key into a single call.
+
+    Callers arriving while a call for their key is in flight wait for and
+    share its result instead of making their own call.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = 0
+
+    def do(self, key, func):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+            else:
+                self.coalesced += 1
+        if not leader:
+            return call.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+def dump_snapshot(caches, path):
+    """Writes the unexpired entries of caches to a snapshot file.
+
+    Snapshots are gzipped JSON lines: a header, then a
+    [cache name, key, expiry time, value] list per entry. Returns the number
+    of entries written.
+    """
+    count = 0
+    with gzip.open(path, "wt", encoding="utf8") as f:
+        f.write(json.dumps({"format": SNAPSHOT_FORMAT,
+                            "version": SNAPSHOT_VERSION,
+                            "created": time.time()}) + "\n")
+        for cache in caches:
+            for key, expires, value in cache.iter_entries():
+                f.write(json.dumps([cache.name, list(key), expires, value]) +
+                        "\n")
+                count += 1
+    return count
+
+
+def load_snapshot(caches, path):
+    """Loads the entries of a snapshot file into the caches of the same
+    name, skipping those which have expired since.
+
+    Returns a dict of the number of entries loaded into each cache.
+    """
+    by_name = {cache.name: cache for cache in caches}
+    pending = {name: [] for name in by_name}
+    loaded = dict.fromkeys(by_name, 0)
+    with gzip.open(path, "rt", encoding="utf8") as f:
+        header = json.loads(f.readline() or "null")
+        if (not isinstance(header, dict) or
+                header.get("format") != SNAPSHOT_FORMAT):
+            raise ValueError("{} is not a cache snapshot".format(path))
+        if header.get("version") != SNAPSHOT_VERSION:
+            raise ValueError("{} is a version {} snapshot, expected version "
+                             "{}".format(path, header.get("version"),
+                                         SNAPSHOT_VERSION))
+
+        for line in f:
+            name, key, expires, value = json.loads(line)
+            if name not in pending:
+                continue
+            pending[name].append((key, expires, value))
+            if len(pending[name]) >= PAGE_SIZE:
+                loaded[name] += by_name[name].load(pending[name])
+                pending[name] = []
+    for name, entries in pending.items():
+        loaded[name] += by_name[name].load(entries)
+    return loaded
+
+
+def identity(value):
+    return value
+
+
+def db_key(key):
+    """Converts a tuple key into the string used in the database."""
+    return ":".join(key)
@@ -0,0 +1,58 @@
+import os
+import sqlite3
+import threading
+
+
+# Let readers map the database into memory instead of copying pages.
+MMAP_SIZE = 64 * 1024 * 1024
+
+
+class Database:
+    """A lazily opened sqlite database.
+
+    A connection is opened per process, so an instance can be created before
+    the bot forks its worker processes and still be used in each of them.
+    The database is in WAL mode so worker processes can read it while
+    another one writes.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self._conn = None
+        self._pid = None
+
+    def connection(self):
+        pid = os.getpid()
+        if self._conn is None or self._pid != pid:
+            # Never close a connection inherited from the parent process, as
+            # the parent may still be using it.
+            conn = sqlite3.connect(self.path, timeout=30,
+                                   isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA mmap_size={}".format(MMAP_SIZE))
+            self._conn = conn
+            self._pid = pid
+        return self._conn
+
+    def execute(self, sql, params=()):
+        """Executes a statement and returns all resulting rows."""
+        with self.lock:
+            return self.connection().execute(sql, params).fetchall()
+
+    def changes(self, sql, params=()):
+        """Executes a statement and returns the number of rows it changed."""
+        with self.lock:
+            return self.connection().execute(sql, params).rowcount
+
+    def executemany(self, sql, seq_of_params):
+        with self.lock:
+            conn = self.connection()
+            conn.execute("BEGIN")
+            try:
+                conn.executemany(sql, seq_of_params)
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
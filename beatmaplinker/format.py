@@ -1,5 +1,6 @@
+import hashlib
+import string
 from .tillerino import ALLOWED_MODES, ALLOWED_APPROVED
-from functools import reduce
 
 MODES = [
     ("0", "Standard"),
@@ -7,14 +8,22 @@ MODES = [
     ("2", "CtB"),
     ("3", "Mania")
 ]
+LINE_BREAK = "\n\n"
+SANITISED_KEYS = ["artist", "creator", "source", "title", "version"]
+# Emphasis characters become HTML entities, and the rest are backslashed.
+MD_ESCAPES = str.maketrans(
+    dict([(c, "&#{:0>4};".format(ord(c))) for c in "*_"] +
+         [(c, "\\" + c) for c in "\\[]^"]))
 
 
 class Formatter:
     def __init__(self, replacements, mapset, map, header="", footer="",
                  selfpost_header=None, selfpost_footer=None, meme_header=None,
                  meme_footer=None, sep="\n\n", char_limit=10000, diff="",
-                 diffs="", pp="", no_pp="", mapset_pp=""):
+                 diffs="", pp="", no_pp="", mapset_pp="", unavailable="",
+                 cache=None):
         self.replacements = replacements
+        self.cache = cache
         self.header = header
         self.footer = footer
 
@@ -35,71 +44,159 @@ class Formatter:
         self.pp = pp
         self.no_pp = no_pp
         self.mapset_pp = mapset_pp
+        self.unavailable = unavailable
 
-    def format_map(self, map_info, pp_info):
-        """Formats a map for a comment given a array of dicts.
+        self.compile()
+
+    def compile(self):
+        """Prebuilds the templates and replacements used by format_map.
 
-        Array of dicts is in the format of osu! API responses.
+        Each replacement section becomes a tuple of its name, the key it
+        looks up and a dict from values of that key to bound format methods.
         """
+        self.render_map = self.map.format
+        self.render_mapset = self.mapset.format
+        self.render_diff = self.diff.format
+        self.render_diffs = self.diffs.format
+        self.render_pp = self.pp.format
+        self.render_no_pp = self.no_pp.format
+        self.render_mapset_pp = self.mapset_pp.format
+
+        self.replacement_tables = []
+        fingerprint = hashlib.sha1()
+        for template in [self.map, self.mapset, self.diff, self.diffs,
+                         self.pp, self.no_pp, self.mapset_pp]:
+            fingerprint.update(template.encode("utf8") + b"\0")
+        # Formatted with a map's info.
+        info_templates = [self.map, self.mapset, self.pp, self.no_pp,
+                          self.mapset_pp]
+        # Looked up by replacements.
+        keys = set()
+        for sect in self.replacements.sections():
+            options = {}
+            for option in self.replacements.options(sect):
+                value = self.replacements.get(sect, option)
+                options[option] = value.format
+                info_templates.append(value)
+                fingerprint.update("{}\0{}\0{}\0".format(sect, option, value)
+                                   .encode("utf8"))
+            key = self.replacements.get(sect, "_key")
+            keys.add(key)
+            self.replacement_tables.append((sect, key, options))
+
+        # The osu! API fields the templates use, so responses can be cut
+        # down to them.
+        computed = {"diff_display", "pp_display", "pp_info"}
+        computed.update(self.replacements.sections())
+        self.fields = frozenset(
+            field for template in info_templates
+            for field in template_fields(template)).union(keys) - computed
+
+        # Rendered maps are cached under this, so changing the templates or
+        # replacements never serves maps rendered with the old ones.
+        self.fingerprint = fingerprint.hexdigest()
+
+    def format_map(self, map_info, pp_info):
+        """Formats a map for a comment given its Mapset."""
         if not map_info:  # invalid beatmap
             return "Invalid map."
-        info = dict(map_info[0])  # create new instance, just in case.
-
-        info["difficultyrating"] = float(info["difficultyrating"])
-        info["hit_length"] = seconds_to_string(int(info["hit_length"]))
-        info["total_length"] = seconds_to_string(int(info["total_length"]))
-
-        diff_strings = []
-        for num, mode in MODES:
-            difficulties = [float(diff["difficultyrating"])
-                            for diff in map_info
-                            if diff["mode"] == num]
-            if not difficulties:
-                continue
-            diff_dict = {
-                "lowest_diff": min(difficulties),
-                "highest_diff": max(difficulties),
-                "diffs": len(difficulties),
-                "mode": mode
-            }
-
-            if diff_dict["diffs"] == 1:
-                diff_strings.append(self.diff.format(**diff_dict))
-            else:
-                diff_strings.append(self.diffs.format(**diff_dict))
-
-        info["diff_display"] = "\n".join(diff_strings)
-
-        # Sanitised inputs
-        for key in ["artist", "creator", "source", "title", "version"]:
-            info[key] = sanitise_md(info[key])
-
-        for sect in self.replacements.sections():
-            section_obj = self.replacements[sect]
-            info[sect] = section_obj[info[section_obj["_key"]]].format(**info)
+        if self.cache is None:
+            return self.render(map_info, pp_info)
+
+        key = self.cache_key(map_info, pp_info)
+        out = self.cache.get(key)
+        if out is None:
+            out = self.render(map_info, pp_info)
+            self.cache.set(key, out)
+        return out
+
+    def format_unavailable(self, map_tuple):
+        """Formats a map whose info couldn't be fetched in time."""
+        map_type, map_id = map_tuple
+        return self.unavailable.format(type=map_type, id=map_id)
+
+    def cache_key(self, map_info, pp_info):
+        """Returns the key a rendered map is cached under."""
+        first = map_info.first
+        if len(map_info) == 1:
+            map_id = ("b", first.beatmap_id)
+        else:
+            map_id = ("s", first.beatmapset_id)
+        pp_key = tuple(sorted(pp_info.items())) if pp_info else ()
+        return map_id + (len(map_info), first.last_update, first.approved,
+                         pp_key, self.fingerprint)
+
+    def render(self, map_info, pp_info):
+        """Renders a valid map without going through the cache."""
+        info = map_info.first.to_dict()
+
+        info["hit_length"] = seconds_to_string(info["hit_length"])
+        info["total_length"] = seconds_to_string(info["total_length"])
+        info["diff_display"] = self.format_diffs(map_info)
+
+        # Sanitised inputs, of those the templates use
+        for key in SANITISED_KEYS:
+            if key in info:
+                info[key] = sanitise_md(info[key])
+
+        optionxform = self.replacements.optionxform
+        for sect, key, options in self.replacement_tables:
+            value = info[key]
+            render = options.get(value)
+            if render is None:
+                render = options[optionxform(value)]
+            info[sect] = render(**info)
 
         if len(map_info) == 1:  # single map
             if (info["mode"] in ALLOWED_MODES and
                     info["approved"] in ALLOWED_APPROVED):
                 if pp_info:
-                    info["pp_display"] = self.pp.format(pp_info=pp_info,
+                    info["pp_display"] = self.render_pp(pp_info=pp_info,
                                                         **info)
                 else:
-                    info["pp_display"] = self.no_pp.format(**info)
+                    info["pp_display"] = self.render_no_pp(**info)
             else:
                 info["pp_display"] = ""
 
-            return self.map.format(**info)
+            return self.render_map(**info)
         else:  # beatmap set
             if info["approved"] in ALLOWED_APPROVED:
-                info["pp_display"] = self.mapset_pp.format(**info)
+                info["pp_display"] = self.render_mapset_pp(**info)
             else:
                 info["pp_display"] = ""
 
-            return self.mapset.format(**info)
+            return self.render_mapset(**info)
+
+    def format_maps(self, map_infos, pp_infos):
+        """Formats many maps given a list of each map's info and pp info."""
+        return list(map(self.format_map, map_infos, pp_infos))
+
+    def format_diffs(self, map_info):
+        """Summarises the difficulties of each mode."""
+        diff_strings = []
+        for num, mode in MODES:
+            diffs = map_info.modes.get(num)
+            if diffs is None:
+                continue
+            stars = [diff.difficultyrating for diff in diffs]
+            render = self.render_diff if len(diffs) == 1 else self.render_diffs
+            diff_strings.append(render(lowest_diff=min(stars),
+                                       highest_diff=max(stars),
+                                       diffs=len(diffs),
+                                       mode=mode))
+        return "\n".join(diff_strings)
 
     def format_comments(self, maps, selfpost=False, meme=False):
         """Formats a list of map strings into a list of comments."""
+        chunker = self.chunker(selfpost, meme)
+        bodies = []
+        for beatmap in maps:
+            bodies.extend(chunker.add(beatmap))
+        bodies.extend(chunker.finish())
+        return bodies
+
+    def chunker(self, selfpost=False, meme=False):
+        """Returns a Chunker splitting map strings into comments."""
         header = self.header
         footer = self.footer
         if selfpost:
@@ -113,49 +210,90 @@ class Formatter:
             if self.meme_footer is not None:
                 footer = self.meme_footer
 
-        line_break = "\n\n"
-        if header:
-            bodies = [header + line_break]  # start w/ header
-        else:
-            bodies = [""]
-
-        f_len, s_len, b_len = map(len, [footer, self.sep, line_break])
-
+        f_len = 0
         if self.footer:
-            f_len += b_len  # footer will always be with a line break
-        else:
-            f_len = 0
+            # footer will always be with a line break
+            f_len = len(footer) + len(LINE_BREAK)
+        return Chunker(header, footer, f_len, self.sep, self.char_limit)
 
-        first_map = True
-        for beatmap in maps:
-            next_len = len(bodies[-1]) + len(beatmap) + f_len
 
-            if not first_map:  # first map of comment means no separator
-                next_len += s_len
+class Chunker:
+    """Splits map strings into comments as they arrive.
 
-            new_comment_after = False
-            if next_len > self.char_limit:  # comment char limit
-                if next_len - f_len > self.char_limit or beatmap is maps[-1]:
-                    bodies.append("")
-                    first_map = True
-                else:
-                    # we cram it in by removing footer + it's not the last map
-                    # sometimes I wish Python had a defer statement
-                    new_comment_after = True
+    Each map is held back until the next one arrives, as the last map of all
+    is never crammed in by dropping the footer, so comments come out exactly
+    as if every map was known up front.
+    """
+    def __init__(self, header, footer, f_len, sep, char_limit):
+        self.footer = footer
+        self.f_len = f_len
+        self.sep = sep
+        self.char_limit = char_limit
 
-            if first_map:
-                first_map = False
+        self.parts = [header + LINE_BREAK] if header else []  # start w/ header
+        self.length = sum(map(len, self.parts))
+        self.first_map = True
+        self.pending = None
+
+    def add(self, beatmap):
+        """Adds the next map string, returning a list of the comments it
+        completed."""
+        done = []
+        if self.pending is not None:
+            self.place(self.pending, False, done)
+        self.pending = beatmap
+        return done
+
+    def finish(self):
+        """Returns a list of the remaining comments, after the last map."""
+        done = []
+        if self.pending is not None:
+            self.place(self.pending, True, done)
+            self.pending = None
+        if self.footer:
+            self.parts.append(LINE_BREAK + self.footer)
+        done.append("".join(self.parts))
+        return done
+
+    def place(self, beatmap, last, done):
+        next_len = self.length + len(beatmap) + self.f_len
+        if not self.first_map:  # first map of comment means no separator
+            next_len += len(self.sep)
+
+        new_comment_after = False
+        if next_len > self.char_limit:  # comment char limit
+            if next_len - self.f_len > self.char_limit or last:
+                self.new_comment(done)
             else:
-                bodies[-1] += self.sep
-            bodies[-1] += beatmap
+                # we cram it in by removing footer + it's not the last map
+                # sometimes I wish Python had a defer statement
+                new_comment_after = True
 
-            if new_comment_after:
-                bodies.append("")
-                first_map = True
+        if self.first_map:
+            self.first_map = False
+        else:
+            self.parts.append(self.sep)
+            self.length += len(self.sep)
+        self.parts.append(beatmap)
+        self.length += len(beatmap)
 
-        if footer:
-            bodies[-1] += line_break + footer
-        return bodies
+        if new_comment_after:
+            self.new_comment(done)
+
+    def new_comment(self, done):
+        done.append("".join(self.parts))
+        self.parts = []
+        self.length = 0
+        self.first_map = True
+
+
+def template_fields(template):
+    """Yields the names of the fields a format string uses."""
+    for _, field, spec, _ in string.Formatter().parse(template):
+        if field:
+            yield field.split(".")[0].split("[")[0]
+        if spec:
+            yield from template_fields(spec)
 
 
 def seconds_to_string(seconds):
@@ -165,9 +303,7 @@ def seconds_to_string(seconds):
 
 def sanitise_md(string):
     """Escapes any markdown characters in string."""
-    emphasis = "*_"
-    escaped = reduce(lambda a, b: a.replace(b, "&#{:0>4};".format(ord(b))),
-                     emphasis, string)
-    other_chars = list("\\[]^") + ["~~"]
-    escaped = reduce(lambda a, b: a.replace(b, "\\" + b), other_chars, escaped)
+    escaped = string.translate(MD_ESCAPES)
+    if "~~" in escaped:
+        escaped = escaped.replace("~~", "\\~~")
     return escaped
@@ -0,0 +1,93 @@
+import time
+
+# Seconds after which a claim on a thing we haven't replied to lapses, in case
+# the worker holding it died.
+CLAIM_TTL = 600
+
+
+class ReplyLedger:
+    """A persistent record of the things the bot has replied to.
+
+    Things are identified by their fullname, such as t1_dk3bw8c. The ledger
+    is complete for things created after since: the bot can't have replied
+    to such a thing without the reply showing up in its comment history.
+
+    Workers sharing the ledger's database claim things before replying to
+    them, so two workers never reply to the same thing.
+    """
+    def __init__(self, db):
+        self.db = db
+        self.replied = set()
+        self.since = None
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS replied ("
+                        "fullname TEXT PRIMARY KEY, "
+                        "replied_at REAL NOT NULL)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS claims ("
+                        "fullname TEXT PRIMARY KEY, "
+                        "claimed_at REAL NOT NULL)")
+
+    def __contains__(self, fullname):
+        if fullname in self.replied:
+            return True
+        rows = self.db.execute("SELECT 1 FROM replied WHERE fullname = ?",
+                               (fullname,))
+        if rows:
+            self.replied.add(fullname)
+        return bool(rows)
+
+    def add(self, fullname, replied_at=None):
+        if replied_at is None:
+            replied_at = time.time()
+        self.db.execute("INSERT OR IGNORE INTO replied VALUES (?, ?)",
+                        (fullname, replied_at))
+        self.replied.add(fullname)
+        self.release(fullname)
+
+    def claim(self, fullname):
+        """Claims a thing for this worker to reply to.
+
+        Returns False if the thing was replied to, or another worker holds
+        a claim on it which hasn't lapsed.
+        """
+        if fullname in self.replied:
+            return False
+        # Checking replied in the same statement means a worker which adds
+        # the thing just before can't be missed.
+        now = time.time()
+        return self.db.changes(
+            "INSERT INTO claims SELECT ?, ? WHERE NOT EXISTS ("
+            "SELECT 1 FROM replied WHERE fullname = ?) "
+            "ON CONFLICT (fullname) "
+            "DO UPDATE SET claimed_at = excluded.claimed_at "
+            "WHERE claims.claimed_at <= ?",
+            (fullname, now, fullname, now - CLAIM_TTL)) > 0
+
+    def release(self, fullname):
+        """Gives up a claim on a thing."""
+        self.db.execute("DELETE FROM claims WHERE fullname = ?", (fullname,))
+
+    def covers(self, created_utc):
+        """Checks whether the ledger knows every reply to a thing created at
+        created_utc."""
+        return self.since is not None and created_utc >= self.since
+
+    def build(self, comments, limit):
+        """Indexes the parents of the bot's own comments.
+
+        comments should be the bot's comment history, newest first, fetched
+        with the given limit.
+        """
+        rows = []
+        oldest = None
+        for comment in comments:
+            rows.append((comment.parent_id, comment.created_utc))
+            oldest = comment.created_utc
+        self.db.executemany("INSERT OR IGNORE INTO replied VALUES (?, ?)",
+                            rows)
+        self.replied.update(fullname for fullname, _ in rows)
+
+        if limit is None or len(rows) < limit:
+            self.since = 0  # we've seen the whole history
+        else:
+            self.since = oldest
@@ -0,0 +1,225 @@
+import glob
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 300)
+
+
+class Registry:
+    """Counters, gauges and histograms for a process.
+
+    Metrics are keyed by name and a tuple of sorted (label, value) pairs.
+    Collectors are functions called on every snapshot which return a list of
+    (kind, name, labels, value) tuples, for stats kept elsewhere.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.collectors = []
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, label_key(labels))] = value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, label_key(labels))
+        with self.lock:
+            hist = self.histograms.get(key)
+            if hist is None:
+                hist = self.histograms[key] = {
+                    "buckets": list(buckets),
+                    "counts": [0] * (len(buckets) + 1),
+                    "sum": 0.0
+                }
+            for i, bound in enumerate(hist["buckets"]):
+                if value <= bound:
+                    break
+            else:
+                i = len(hist["buckets"])
+            hist["counts"][i] += 1
+            hist["sum"] += value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observes how long the body of a with statement takes."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def sums(self, name):
+        """Returns the sum of every histogram of a name, keyed by its label
+        key."""
+        with self.lock:
+            return {labels: hist["sum"]
+                    for (hist_name, labels), hist in self.histograms.items()
+                    if hist_name == name}
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def snapshot(self):
+        """Returns a JSON serialisable dict of every metric."""
+        collected = []
+        for collector in self.collectors:
+            try:
+                collected.extend(collector())
+            except Exception as e:
+                print("metrics collector failed:", e)
+
+        with self.lock:
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            histograms = {key: dict(hist, counts=list(hist["counts"]))
+                          for key, hist in self.histograms.items()}
+        for kind, name, labels, value in collected:
+            key = (name, label_key(labels))
+            if kind == "counter":
+                counters[key] = counters.get(key, 0) + value
+            else:
+                gauges[key] = value
+
+        return {
+            "time": time.time(),
+            "counters": [[name, dict(labels), value]
+                         for (name, labels), value in counters.items()],
+            "gauges": [[name, dict(labels), value]
+                       for (name, labels), value in gauges.items()],
+            "histograms": [[name, dict(labels), hist]
+                           for (name, labels), hist in histograms.items()]
+        }
+
+    def write(self, path):
+        write_atomic(path, json.dumps(self.snapshot()))
+
+
+def label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def write_atomic(path, text):
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, "w", encoding="utf8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def combine(snapshots):
+    """Combines snapshots from many workers into one.
+
+    Counters and histograms are summed. Gauges are kept apart by the name of
+    the worker they came from.
+    """
+    counters = {}
+    gauges = {}
+    histograms = {}
+    for worker, snapshot in snapshots.items():
+        for name, labels, value in snapshot["counters"]:
+            key = (name, label_key(labels))
+            counters[key] = counters.get(key, 0) + value
+        for name, labels, value in snapshot["gauges"]:
+            gauges[(name, label_key(dict(labels, worker=worker)))] = value
+        for name, labels, hist in snapshot["histograms"]:
+            key = (name, label_key(labels))
+            total = histograms.get(key)
+            if total is None or total["buckets"] != hist["buckets"]:
+                histograms[key] = dict(hist, counts=list(hist["counts"]))
+                continue
+            total["counts"] = [a + b for a, b in zip(total["counts"],
+                                                     hist["counts"])]
+            total["sum"] += hist["sum"]
+    return counters, gauges, histograms
+
+
+def to_prometheus(counters, gauges, histograms, prefix="beatmaplinker_"):
+    """Renders combined metrics in the Prometheus text format."""
+    lines = []
+    for kind, metrics in [("counter", counters), ("gauge", gauges)]:
+        last_name = None
+        for (name, labels), value in sorted(metrics.items()):
+            if name != last_name:
+                lines.append("# TYPE {}{} {}".format(prefix, name, kind))
+                last_name = name
+            lines.append("{}{}{} {}".format(prefix, name,
+                                            format_labels(labels), value))
+
+    last_name = None
+    for (name, labels), hist in sorted(histograms.items()):
+        if name != last_name:
+            lines.append("# TYPE {}{} histogram".format(prefix, name))
+            last_name = name
+        cumulative = 0
+        bounds = [str(b) for b in hist["buckets"]] + ["+Inf"]
+        for bound, count in zip(bounds, hist["counts"]):
+            cumulative += count
+            lines.append("{}{}_bucket{} {}".format(
+                prefix, name, format_labels(labels + (("le", bound),)),
+                cumulative))
+        lines.append("{}{}_sum{} {}".format(prefix, name,
+                                            format_labels(labels),
+                                            hist["sum"]))
+        lines.append("{}{}_count{} {}".format(prefix, name,
+                                              format_labels(labels),
+                                              cumulative))
+    return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, v.replace('"', '\\"'))
+                          for k, v in labels) + "}"
+
+
+def export(directory):
+    """Combines every worker's snapshot in directory into metrics.prom."""
+    snapshots = {}
+    for path in glob.glob(os.path.join(directory, "*.json")):
+        worker = os.path.splitext(os.path.basename(path))[0]
+        try:
+            with open(path, encoding="utf8") as f:
+                snapshots[worker] = json.load(f)
+        except (OSError, ValueError) as e:
+            print("Couldn't read metrics from", path, e)
+    write_atomic(os.path.join(directory, "metrics.prom"),
+                 to_prometheus(*combine(snapshots)))
+
+
+def start_writer(directory, worker, interval, combined=False):
+    """Starts a thread writing this process' metrics to directory.
+
+    If combined, the thread also exports the metrics of every worker.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, worker + ".json")
+
+    def write_forever():
+        while True:
+            try:
+                REGISTRY.write(path)
+                if combined:
+                    export(directory)
+            except Exception as e:
+                print("Couldn't write metrics:", e)
+            time.sleep(interval)
+
+    thread = threading.Thread(target=write_forever, daemon=True)
+    thread.start()
+    return thread
+
+
+# The registry every module records its metrics in.
+REGISTRY = Registry()
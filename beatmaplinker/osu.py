@@ -1,17 +1,126 @@
-import requests
+from .beatmap import Mapset
+from .cache import SingleFlight
+from .metrics import REGISTRY
+from .ratelimit import RateLimitTimeout, TokenBucket
+from .session import CircuitBreaker, Session
+
+API_URL = "https://osu.ppy.sh/api/get_beatmaps"
+# Ranked, Approved and Loved maps practically never change.
+STABLE_APPROVED = {"1", "2", "4"}
 
 
 class Osu:
     """An osu! API wrapper."""
-    def __init__(self, api_key):
+    def __init__(self, api_key, cache=None, set_ids=None, stable_ttl=259200,
+                 unstable_ttl=300, negative_ttl=600, connect_timeout=5,
+                 read_timeout=10, retries=2, backoff=0.5, rate=0, burst=1,
+                 failure_threshold=5, reset_timeout=30, api_url=API_URL,
+                 extra_fields=()):
         self.api_key = api_key
+        self.api_url = api_url
+        self.session = Session(connect_timeout, read_timeout, retries,
+                               backoff)
+        self.limiter = None
+        if float(rate) > 0:
+            self.limiter = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker("osu!api", failure_threshold,
+                                      reset_timeout)
+        self.cache = cache
+        # Maps beatmap ids to the id of their set, which never changes.
+        self.set_ids = set_ids
+        self.flights = SingleFlight()
+        self.stable_ttl = int(stable_ttl)
+        self.unstable_ttl = int(unstable_ttl)
+        self.negative_ttl = int(negative_ttl)
+        # Fields of responses to keep besides those Beatmap has slots for.
+        self.extra_fields = tuple(extra_fields)
+
+    def get_beatmap_info(self, map_tuple, priority=0, within=None):
+        """Gets information about a beatmap given a tuple of type and id, as
+        a Mapset.
+
+        Difficulties of a set we know of are sliced out of the set's
+        response, so linking many difficulties of one set only makes one
+        request. Requests with a lower priority number are sent first when
+        rate limited, and time out after within seconds if that's sooner
+        than the configured timeouts.
+        """
+        map_type, map_id = map_tuple
+        if self.cache is not None:
+            out = self.cache.get((map_type, map_id))
+            if out is not None:
+                return out
+
+        set_id = self.get_set_id(map_tuple)
+        if set_id is not None:
+            set_info = self.get_beatmap_info(("s", set_id), priority, within)
+            out = set_info.difficulty(map_id)
+            # The difficulty may have been deleted from the set since.
+            if out:
+                return out
+        return self.flights.do(
+            (map_type, map_id),
+            lambda: self.fetch(map_type, map_id, priority, within))
+
+    def get_set_id(self, map_tuple):
+        """Returns the set id of a difficulty if we know it, otherwise None.
 
-    def get_beatmap_info(self, map_tuple):
-        """Gets information about a beatmap given a tuple of type and id."""
+        Set responses are only worth using with a cache to keep them in.
+        """
         map_type, map_id = map_tuple
+        if map_type != "b" or self.cache is None or self.set_ids is None:
+            return None
+        return self.set_ids.get((map_id,))
+
+    def knows_set(self, map_tuple):
+        """Returns whether the set a map tuple belongs to is known."""
+        return map_tuple[0] == "s" or self.get_set_id(map_tuple) is not None
+
+    def fetch(self, map_type, map_id, priority=0, within=None):
+        """Requests information about a beatmap from the osu! API.
+
+        Maps which don't exist are cached for a short time, so we don't ask
+        about them on every mention.
+        """
+        self.breaker.check()
+        if self.limiter is not None:
+            try:
+                within = self.limiter.acquire(priority, within)
+            except RateLimitTimeout:
+                self.breaker.inconclusive()
+                raise
         payload = {"k": self.api_key, map_type: map_id}
-        r = requests.get("https://osu.ppy.sh/api/get_beatmaps", params=payload)
-        out = r.json()
+        try:
+            r = self.session.get(self.api_url, within, params=payload)
+            out = r.json()
+        except Exception as e:
+            if self.session.shortened(within):
+                self.breaker.inconclusive()
+            else:
+                self.breaker.failure()
+            REGISTRY.inc("api_errors_total", api="osu", type=type(e).__name__)
+            raise
         if "error" in out:
+            self.breaker.failure()
+            REGISTRY.inc("api_errors_total", api="osu", type="error_response")
             raise Exception("osu!api returned an error of " + out["error"])
+        self.breaker.success()
+        out = Mapset.from_response(out, self.extra_fields)
+
+        if self.cache is not None:
+            if out:
+                self.cache.set((map_type, map_id), out, self.get_ttl(out))
+            else:
+                self.cache.set((map_type, map_id), out, self.negative_ttl)
+        if self.set_ids is not None:
+            for beatmap in out:
+                key = (beatmap.beatmap_id,)
+                if self.set_ids.get(key) is None:
+                    self.set_ids.set(key, beatmap.beatmapset_id)
         return out
+
+    def get_ttl(self, map_info):
+        """Returns how long a get_beatmaps response may be cached for."""
+        if map_info.first.approved in STABLE_APPROVED:
+            return self.stable_ttl
+        return self.unstable_ttl
@@ -0,0 +1,110 @@
+import threading
+import time
+
+
+class Outbox:
+    """A persistent queue of the comments the bot is yet to post.
+
+    The comments replying to a thing form a chain, each replying to the one
+    before, and are posted in order by a poster which may run in another
+    thread. Posted comments are recorded, so after a crash the poster
+    resumes a chain from the last comment it posted.
+
+    Every worker process of the bot has its own owner name, and only posts
+    the chains it queued itself. The database may be shared by them all, so
+    a thing is only ever queued once.
+    """
+    def __init__(self, db, owner):
+        self.db = db
+        self.owner = owner
+        self.wake = threading.Event()
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS chains ("
+                        "fullname TEXT PRIMARY KEY, "
+                        "owner TEXT NOT NULL, "
+                        "queued_at REAL NOT NULL, "
+                        "complete INTEGER NOT NULL DEFAULT 0)")
+        self.db.execute("CREATE TABLE IF NOT EXISTS chunks ("
+                        "fullname TEXT NOT NULL, "
+                        "seq INTEGER NOT NULL, "
+                        "text TEXT NOT NULL, "
+                        "posted TEXT, "
+                        "PRIMARY KEY (fullname, seq))")
+
+    def recover(self):
+        """Marks the chains this owner was queueing when it last stopped as
+        complete, so they're posted as far as they got."""
+        self.db.execute("UPDATE chains SET complete = 1 WHERE owner = ?",
+                        (self.owner,))
+        for (fullname,) in self.db.execute("SELECT fullname FROM chains "
+                                           "WHERE owner = ?", (self.owner,)):
+            self.cleanup(fullname)
+        self.wake.set()
+
+    def start(self, fullname):
+        """Starts a chain replying to a thing, returning False if one was
+        already queued."""
+        return self.db.changes(
+            "INSERT OR IGNORE INTO chains (fullname, owner, queued_at) "
+            "VALUES (?, ?, ?)", (fullname, self.owner, time.time())) > 0
+
+    def add(self, fullname, seq, text):
+        """Queues the comment at position seq of a chain."""
+        self.db.execute("INSERT INTO chunks (fullname, seq, text) "
+                        "VALUES (?, ?, ?)", (fullname, seq, text))
+        self.wake.set()
+
+    def finish(self, fullname):
+        """Marks a chain as having every comment queued."""
+        self.db.execute("UPDATE chains SET complete = 1 WHERE fullname = ?",
+                        (fullname,))
+        self.cleanup(fullname)
+
+    def next(self):
+        """Returns (fullname, seq, text, parent) of the next comment of this
+        owner's to post, or None if there are none ready.
+
+        parent is the fullname of what the comment replies to: the thing for
+        the first comment of a chain, otherwise the comment before it.
+        Chains are posted in the order they were queued, but one waiting on
+        its next comment doesn't hold up the others.
+        """
+        rows = self.db.execute(
+            "SELECT c.fullname, c.seq, c.text, "
+            "COALESCE(p.posted, c.fullname) FROM chunks c "
+            "JOIN chains ON chains.fullname = c.fullname "
+            "LEFT JOIN chunks p ON p.fullname = c.fullname "
+            "AND p.seq = c.seq - 1 "
+            "WHERE chains.owner = ? AND c.posted IS NULL "
+            "AND (c.seq = 0 OR p.posted IS NOT NULL) "
+            "ORDER BY chains.queued_at, c.seq LIMIT 1", (self.owner,))
+        return rows[0] if rows else None
+
+    def posted(self, fullname, seq, comment_fullname):
+        """Records that a comment of a chain was posted."""
+        self.db.execute("UPDATE chunks SET posted = ? "
+                        "WHERE fullname = ? AND seq = ?",
+                        (comment_fullname, fullname, seq))
+        self.cleanup(fullname)
+
+    def drop(self, fullname):
+        """Gives up on the rest of a chain."""
+        self.db.execute("DELETE FROM chunks WHERE fullname = ?", (fullname,))
+        self.db.execute("DELETE FROM chains WHERE fullname = ?", (fullname,))
+
+    def cleanup(self, fullname):
+        """Forgets a chain once every comment of it is queued and posted."""
+        rows = self.db.execute(
+            "SELECT 1 FROM chains WHERE fullname = ? AND complete = 1 "
+            "AND NOT EXISTS (SELECT 1 FROM chunks WHERE fullname = ? "
+            "AND posted IS NULL)", (fullname, fullname))
+        if rows:
+            self.drop(fullname)
+
+    def pending(self):
+        """Returns the number of this owner's comments yet to be posted."""
+        return self.db.execute(
+            "SELECT COUNT(*) FROM chunks JOIN chains "
+            "ON chains.fullname = chunks.fullname "
+            "WHERE chains.owner = ? AND chunks.posted IS NULL",
+            (self.owner,))[0][0]
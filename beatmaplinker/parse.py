@@ -5,6 +5,17 @@ import re
 URL_REGEX = re.compile(r'<a href="(?P<url>https?://(?:osu|old)\.ppy\.sh/[^"]+)">(?P=url)</a>')  # NOQA
 NEW_SITE_PATH = "/beatmapsets/"
 
+# Matches the same links as URL_REGEX, also capturing the map of common URL
+# shapes. rest is whatever follows the map id.
+MAP_LINK_REGEX = re.compile(
+    r'<a href="(?P<url>https?://(?:osu|old)\.ppy\.sh/(?=[^"])'
+    r'(?:(?P<type>[bs])/(?P<id>[0-9]+)'
+    r'|beatmapsets/(?P<set_id>[0-9]+)'
+    r'|p/beatmap\?(?P<query_type>[bs])=(?P<query_id>[0-9]+))?'
+    r'(?P<rest>[^"]*))">(?P=url)</a>')
+# After a map id in the path, these can't change what get_map_params returns.
+PATH_REST_REGEX = re.compile(r"/*(?:[?#][^&;]*)?")
+
 
 def get_map_params(url):
     """Returns a tuple of (map_type, map_id) or None if URL is invalid.
@@ -53,3 +64,48 @@ def get_map_params(url):
 def get_links_from_html(html_string):
     """Returns a list of all osu! URLs from a HTML string."""
     return [html.unescape(z) for z in URL_REGEX.findall(html_string)]
+
+
+def get_maps_from_html(html_string):
+    """Returns a list of (map_type, map_id) tuples linked in a HTML string.
+
+    Equivalent to calling get_map_params on every link from
+    get_links_from_html and dropping the Nones, but skips parsing URLs of
+    the usual shapes. Anything unusual goes through get_map_params.
+    """
+    out = []
+    for match in MAP_LINK_REGEX.finditer(html_string):
+        map_type, map_id, rest = match.group("type", "id", "rest")
+        if map_type is None:
+            map_type, map_id = "s", match.group("set_id")
+        if map_id is not None:
+            if PATH_REST_REGEX.fullmatch(rest):
+                out.append((map_type, map_id))
+                continue
+        else:
+            map_type, map_id = match.group("query_type", "query_id")
+            # The first query parameter is the map, unless a b parameter
+            # comes after an s parameter.
+            if (map_type is not None and
+                    (not rest or rest[0] == "#" or
+                     rest.startswith("&amp;")) and
+                    (map_type == "b" or "b" not in rest)):
+                out.append((map_type, map_id))
+                continue
+
+        params = get_map_params(html.unescape(match.group("url")))
+        if params:
+            out.append(params)
+    return out
+
+
+def get_maps_from_raw_html(raw_html):
+    """Returns a list of (map_type, map_id) tuples linked in raw HTML.
+
+    Raw HTML is escaped the way reddit sends it, which never escapes the
+    characters of "ppy.sh". As most things link no maps at all, those are
+    rejected before unescaping anything.
+    """
+    if "ppy.sh" not in raw_html:
+        return []
+    return get_maps_from_html(html.unescape(raw_html))
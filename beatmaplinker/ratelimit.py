@@ -0,0 +1,186 @@
+import contextlib
+import multiprocessing as mp
+import os
+import time
+
+# Most requests which may wait for a token at once, across every process.
+# Requests beyond these wait without a priority.
+MAX_WAITERS = 256
+# Seconds to wait for the lock before checking whether the process holding
+# it died.
+LOCK_TIMEOUT = 2
+
+
+class RateLimitTimeout(Exception):
+    """Raised when a request can't be made in the time it has left."""
+
+
+class TokenBucket:
+    """A token bucket rate limiter.
+
+    The bucket lives in shared memory, so processes forked after it is
+    created share the same rate. Waiting requests are prioritised: a request
+    only takes a token when no more urgent request is waiting. Priorities
+    are integers from 0 (most urgent) up to levels - 1.
+
+    Waiting requests are recorded with their process' pid, so those of a
+    process which died while waiting are forgotten, as is the lock if it
+    died holding it.
+    """
+    def __init__(self, rate, burst, levels=4):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.levels = levels
+        self.lock = mp.Lock()
+        self.holder = mp.RawValue("i", 0)
+        self.tokens = mp.RawValue("d", self.burst)
+        self.updated = mp.RawValue("d", time.monotonic())
+        # The pid and priority of each waiting request, with a pid of 0 for
+        # free slots.
+        self.waiter_pids = mp.RawArray("i", MAX_WAITERS)
+        self.waiter_levels = mp.RawArray("i", MAX_WAITERS)
+
+        self.acquired = mp.RawValue("q", 0)
+        self.waits = mp.RawValue("q", 0)
+        self.wait_time = mp.RawValue("d", 0.0)
+        self.max_wait_time = mp.RawValue("d", 0.0)
+
+    def acquire(self, priority=0, timeout=None):
+        """Blocks until a request may be made.
+
+        Raises RateLimitTimeout if that's not within timeout seconds, and
+        otherwise returns what's left of timeout, or None if there's none.
+        """
+        level = min(max(priority, 0), self.levels - 1)
+        start = time.monotonic()
+        slot = self._take(level, None)
+        if slot is True:
+            self._record(0.0)
+            return timeout
+
+        try:
+            while True:
+                taken = self._take(level, slot)
+                if taken is True:
+                    break
+                # Requests which found every slot taken get one once it's
+                # free, so it's freed with the rest.
+                slot = taken
+                with self._locked():
+                    delay = (1 - self.tokens.value) / self.rate
+                # A more urgent request may take the next token, so check
+                # again once it should have.
+                delay = max(delay, 1 / self.rate)
+                if timeout is not None:
+                    left = start + timeout - time.monotonic()
+                    if left <= 0:
+                        raise RateLimitTimeout(
+                            "no request could be made within {:.2f}s"
+                            .format(timeout))
+                    delay = min(delay, left)
+                time.sleep(delay)
+        finally:
+            if slot is not None:
+                with self._locked():
+                    self.waiter_pids[slot] = 0
+        waited = time.monotonic() - start
+        self._record(waited)
+        if timeout is None:
+            return None
+        if waited >= timeout:
+            raise RateLimitTimeout("no request could be made within {:.2f}s"
+                                   .format(timeout))
+        return timeout - waited
+
+    def stats(self):
+        """Returns a dict of the bucket's queue and wait time counters."""
+        with self._locked():
+            waits = self.waits.value
+            wait_time = self.wait_time.value
+            return {
+                "queue_depth": len(self._waiters()),
+                "acquired": self.acquired.value,
+                "waits": waits,
+                "wait_time": wait_time,
+                "mean_wait_time": wait_time / waits if waits else 0.0,
+                "max_wait_time": self.max_wait_time.value
+            }
+
+    def _take(self, level, slot):
+        """Takes a token if one is free, returning True.
+
+        Otherwise returns the slot the request waits in, which is taken if
+        it didn't have one yet, or None if every slot is taken.
+        """
+        with self._locked():
+            self._refill(time.monotonic())
+            if (self.tokens.value >= 1 and
+                    not any(other < level for other in self._waiters())):
+                self.tokens.value -= 1
+                return True
+            if slot is None:
+                for i, pid in enumerate(self.waiter_pids):
+                    if pid == 0:
+                        self.waiter_pids[i] = os.getpid()
+                        self.waiter_levels[i] = level
+                        return i
+            return slot
+
+    def _waiters(self):
+        """Returns the priorities of the waiting requests, freeing the slots
+        of processes which died. The lock must be held."""
+        levels = []
+        own = os.getpid()
+        for i, pid in enumerate(self.waiter_pids):
+            if pid == 0:
+                continue
+            if pid != own and not pid_alive(pid):
+                self.waiter_pids[i] = 0
+                continue
+            levels.append(self.waiter_levels[i])
+        return levels
+
+    @contextlib.contextmanager
+    def _locked(self):
+        while not self.lock.acquire(timeout=LOCK_TIMEOUT):
+            holder = self.holder.value
+            if holder and pid_alive(holder):
+                continue
+            # The process holding the lock died with it, so free it.
+            print("Freeing a rate limiter lock held by dead process", holder)
+            try:
+                self.lock.release()
+            except ValueError:  # another process freed it first
+                pass
+        self.holder.value = os.getpid()
+        try:
+            yield
+        finally:
+            self.holder.value = 0
+            self.lock.release()
+
+    def _refill(self, now):
+        elapsed = now - self.updated.value
+        self.tokens.value = min(self.burst,
+                                self.tokens.value + elapsed * self.rate)
+        self.updated.value = now
+
+    def _record(self, waited):
+        with self._locked():
+            self.acquired.value += 1
+            if waited > 0:
+                self.waits.value += 1
+                self.wait_time.value += waited
+                self.max_wait_time.value = max(self.max_wait_time.value,
+                                               waited)
+
+
+def pid_alive(pid):
+    """Checks whether a process is still running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
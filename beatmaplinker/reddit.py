@@ -1,11 +1,27 @@
 import praw
-from functools import reduce
+import prawcore
 import html
+import re
+import time
+from .metrics import REGISTRY
+
+# Seconds the poster waits for something to be queued before looking again.
+OUTBOX_POLL = 5
+# Most seconds the poster waits before retrying after a network error.
+MAX_RETRY_DELAY = 60
+# Seconds to wait after a RATELIMIT error which doesn't say how long for.
+DEFAULT_RATELIMIT = 60
+RATELIMIT_RE = re.compile(r"(\d+) (millisecond|second|minute)")
+RATELIMIT_UNITS = {"millisecond": 0.001, "second": 1, "minute": 60}
+# Errors after which posting the same comment again may work.
+TRANSIENT_ERRORS = (prawcore.exceptions.RequestException,
+                    prawcore.exceptions.ServerError,
+                    prawcore.exceptions.TooManyRequests)
 
 
 class Reddit:
     def __init__(self, username, password, user_agent, subreddit,
-                 client_id, client_secret):
+                 client_id, client_secret, ledger=None, outbox=None):
         self.r = praw.Reddit(client_id=client_id,
                              client_secret=client_secret,
                              user_agent=user_agent,
@@ -14,10 +30,49 @@ class Reddit:
         self.subreddit = self.r.subreddit(subreddit)
 
         self.botname = username
+        self.ledger = ledger
+        self.outbox = outbox
+
+    def adopt(self, thing):
+        """Returns a copy of a thing from another instance which makes its
+        requests, such as replying, with this one.
+
+        The copy keeps what was already fetched of the thing, so nothing is
+        fetched again.
+        """
+        cls = type(thing)
+        copied = cls.__new__(cls)
+        copied.__dict__.update(thing.__dict__)
+        copied._reddit = self.r
+        return copied
+
+    def build_ledger(self, limit):
+        """Indexes the things the bot replied to from its comment history."""
+        if self.ledger is None:
+            return
+        comments = self.r.redditor(self.botname).comments.new(limit=limit)
+        self.ledger.build(comments, limit)
 
     def has_replied(self, t):
         """Checks whether the bot has replied to a thing already.
 
+        Looks in the reply ledger first, and only asks reddit about things
+        older than the ledger covers.
+        """
+        with REGISTRY.timer("stage_seconds", stage="has_replied"):
+            if self.ledger is not None:
+                if t.fullname in self.ledger:
+                    return True
+                if self.ledger.covers(t.created_utc):
+                    return False
+            replied = self.has_replied_remote(t)
+        if replied and self.ledger is not None:
+            self.ledger.add(t.fullname)
+        return replied
+
+    def has_replied_remote(self, t):
+        """Checks with reddit whether the bot has replied to a thing already.
+
         Apparently costly.
         Taken from http://reddit.com/r/redditdev/comments/1kxd1n/_/cbv4usl"""
         if isinstance(t, praw.models.Comment):
@@ -33,13 +88,35 @@ class Reddit:
     def reply(self, thing, texts):
         """Post comment(s) replying to a thing.
 
-        Takes in a list of comments to chain.
+        Takes in a list of comments to chain. With an outbox, the comments
+        are only queued, for post_queued to post.
+
+        Returns False if another worker holds a claim on the thing, in which
+        case it may still need replying to should that worker die, and True
+        once the bot is done with it.
         """
         if thing.author.name == self.botname:
             print("Replying to self. Terminating.")
-            return
-        return reduce(lambda thing, text: self.reply_single(thing, text),
-                      texts, thing)
+            return True
+        if self.ledger is not None and not self.ledger.claim(thing.fullname):
+            print("Another worker is replying to", thing.fullname)
+            return False
+        if self.outbox is not None:
+            self.queue(thing, texts)
+            return True
+        try:
+            parent = thing
+            for i, text in enumerate(texts):
+                parent = self.reply_single(parent, text)
+                # Later comments reply to our own, so only the first says
+                # we've replied to the thing.
+                if i == 0 and self.ledger is not None:
+                    self.ledger.add(thing.fullname)
+            return True
+        except Exception:
+            if self.ledger is not None:
+                self.ledger.release(thing.fullname)
+            raise
 
     def reply_single(self, thing, text):
         """Post a comment replying to a thing."""
@@ -48,27 +125,156 @@ class Reddit:
 
         if (isinstance(thing, praw.models.Comment) or
             isinstance(thing, praw.models.Submission)):
-            out = thing.reply(text)
+            with REGISTRY.timer("stage_seconds", stage="reply"):
+                out = thing.reply(text)
         else:
             raise Exception("{0} is an invalid thing type".format(type(thing)))
         print("Replied!")
         return out
 
+    def queue(self, thing, texts):
+        """Queues comments replying to a thing in the outbox.
+
+        Each comment is queued as soon as it's made, so the poster can start
+        on the chain while the rest are still being formatted.
+        """
+        if not self.outbox.start(thing.fullname):
+            print("Replies to", thing.fullname, "are queued already")
+            return
+        queued = 0
+        try:
+            for text in texts:
+                self.outbox.add(thing.fullname, queued, text)
+                queued += 1
+        except Exception:
+            if not queued:
+                self.outbox.drop(thing.fullname)
+                if self.ledger is not None:
+                    self.ledger.release(thing.fullname)
+            raise
+        finally:
+            if queued:
+                self.outbox.finish(thing.fullname)
+        print("Queued", queued, "replies to", thing.fullname)
+
+    def post_queued(self):
+        """Posts the comments queued in the outbox, forever.
+
+        Meant to be run in a thread of its own with its own instance, so
+        waiting out reddit's rate limits never holds up reading the streams.
+        PRAW already spaces out requests by reddit's rate limit headers; this
+        sleeps for as long as a RATELIMIT error says to and posts the same
+        comment again, and backs off on network and database errors. A
+        comment reddit refuses outright drops the rest of its chain.
+        """
+        delay = 0
+        while True:
+            try:
+                self.post_next()
+            except Exception as e:
+                delay = min(2 * delay or 1, MAX_RETRY_DELAY)
+                print("Couldn't post a queued reply, retrying in", delay,
+                      "seconds:", e)
+                time.sleep(delay)
+            else:
+                delay = 0
+
+    def post_next(self):
+        """Posts the next comment queued in the outbox, waiting a while for
+        one if there are none.
+
+        Raises on errors after which posting the comment again may work.
+        """
+        self.outbox.wake.clear()
+        queued = self.outbox.next()
+        REGISTRY.set("outbox_pending", self.outbox.pending())
+        if queued is None:
+            self.outbox.wake.wait(OUTBOX_POLL)
+            return
+        fullname, seq, text, parent = queued
+        try:
+            with REGISTRY.timer("stage_seconds", stage="reply"):
+                out = self.get_thing(parent).reply(text)
+        except praw.exceptions.RedditAPIException as e:
+            wait = ratelimit_seconds(e)
+            if wait is None:
+                print("Couldn't reply to", parent, "giving up on",
+                      fullname + ":", e)
+                self.give_up(fullname, seq)
+                return
+            print("Rate limited, sleeping for", wait, "seconds")
+            REGISTRY.inc("reply_ratelimited_total")
+            REGISTRY.inc("reply_ratelimit_sleep_seconds_total", wait)
+            time.sleep(wait)
+            return
+        except TRANSIENT_ERRORS:
+            raise
+        except Exception as e:
+            print("Couldn't reply to", parent, "giving up on",
+                  fullname + ":", e)
+            self.give_up(fullname, seq)
+            return
+        if seq == 0 and self.ledger is not None:
+            self.ledger.add(fullname)
+        REGISTRY.inc("replies_posted_total")
+        remaining = self.r.auth.limits.get("remaining")
+        if remaining is not None:
+            REGISTRY.set("reddit_ratelimit_remaining", remaining)
+        if out is None:
+            # Reddit sometimes doesn't say which comment it made, leaving
+            # nothing for the rest of the chain to reply to.
+            print("Replied to", parent, "but can't chain to the reply,",
+                  "giving up on the rest of", fullname)
+            self.outbox.drop(fullname)
+            return
+        self.outbox.posted(fullname, seq, out.fullname)
+        print("Replied to", parent)
+
+    def give_up(self, fullname, seq):
+        """Drops a chain, letting another worker have a go at the thing if
+        none of it was posted."""
+        self.outbox.drop(fullname)
+        if seq == 0 and self.ledger is not None:
+            self.ledger.release(fullname)
+
+    def get_thing(self, fullname):
+        """Returns a lazy comment or submission from its fullname, which can
+        be replied to without fetching it."""
+        prefix, thing_id = fullname.split("_", 1)
+        if prefix == "t1":
+            return praw.models.Comment(self.r, id=thing_id)
+        if prefix == "t3":
+            return praw.models.Submission(self.r, id=thing_id)
+        raise Exception("{0} is an invalid thing type".format(fullname))
+
     def get_comments(self, limit):
         return self.subreddit.comments(limit=limit)
 
     def get_submissions(self, limit):
         return self.subreddit.new(limit=limit)
 
-    def get_comment_stream(self):
-        return self.subreddit.stream.comments()
+    def get_comment_stream(self, pause_after=None):
+        return self.subreddit.stream.comments(pause_after=pause_after)
 
-    def get_submission_stream(self):
-        return self.subreddit.stream.submissions()
+    def get_submission_stream(self, pause_after=None):
+        return self.subreddit.stream.submissions(pause_after=pause_after)
 
 
-def get_html_from_thing(thing):
-    """Returns the HTML content of a thing."""
+def ratelimit_seconds(e):
+    """Returns the seconds a RATELIMIT error says to wait for, or None if e
+    isn't one."""
+    for item in e.items:
+        if item.error_type == "RATELIMIT":
+            match = RATELIMIT_RE.search(item.message)
+            if match is None:
+                return DEFAULT_RATELIMIT
+            # Reddit rounds down, so wait a second longer.
+            return int(match.group(1)) * RATELIMIT_UNITS[match.group(2)] + 1
+    return None
+
+
+def get_raw_html_from_thing(thing):
+    """Returns the HTML content of a thing, still escaped."""
     if isinstance(thing, praw.models.Comment):
         out = thing.body_html
     elif isinstance(thing, praw.models.Submission):
@@ -77,4 +283,9 @@ def get_html_from_thing(thing):
             return ""
     else:
         raise Exception("{0} is an invalid thing type".format(type(thing)))
-    return html.unescape(out)
+    return out
+
+
+def get_html_from_thing(thing):
+    """Returns the HTML content of a thing."""
+    return html.unescape(get_raw_html_from_thing(thing))
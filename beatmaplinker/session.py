@@ -0,0 +1,183 @@
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+RETRY_STATUSES = (500, 502, 503, 504)
+# Circuit breaker states, numbered as they're exported in metrics.
+CLOSED = 0
+HALF_OPEN = 1
+OPEN = 2
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream believed to be down."""
+
+
+class Session:
+    """A keep-alive HTTP client with timeouts and retries.
+
+    requests.Session may not be thread safe, so every thread of every process
+    gets its own session. Connections are reused between requests made by
+    the same thread.
+    """
+    def __init__(self, connect_timeout=5, read_timeout=10, retries=2,
+                 backoff=0.5, pool_size=10):
+        self.timeout = (float(connect_timeout), float(read_timeout))
+        self.retries = int(retries)
+        self.backoff = float(backoff)
+        self.pool_size = int(pool_size)
+
+        self.lock = threading.Lock()
+        self._pid = None
+        self._local = None
+        self._adapters = []
+
+    def get(self, url, within=None, **kwargs):
+        """Makes a GET request, giving up after within seconds if that's
+        sooner than the configured timeouts allow.
+
+        Requests given less time than usual are only tried once, as there's
+        no time to back off and retry.
+        """
+        shortened = self.shortened(within)
+        kwargs.setdefault("timeout", self.timeout_within(within))
+        return self.session(retry=not shortened).get(url, **kwargs)
+
+    def timeout_within(self, within):
+        """Returns the timeouts for requests which should give up after
+        within seconds."""
+        if within is None:
+            return self.timeout
+        return tuple(min(t, max(within, 0.001)) for t in self.timeout)
+
+    def shortened(self, within):
+        """Checks whether requests giving up after within seconds have
+        shorter timeouts than usual, so failing says little about the
+        server."""
+        return self.timeout_within(within) != self.timeout
+
+    def session(self, retry=True):
+        """Returns the requests.Session of the current thread."""
+        with self.lock:
+            if self._pid != os.getpid():
+                # Sockets inherited from a parent process must not be shared.
+                self._pid = os.getpid()
+                self._local = threading.local()
+                self._adapters = []
+            local = self._local
+
+        name = "session" if retry else "single_try_session"
+        session = getattr(local, name, None)
+        if session is None:
+            session = self.new_session(self.retries if retry else 0)
+            setattr(local, name, session)
+        return session
+
+    def new_session(self, retries=None):
+        if retries is None:
+            retries = self.retries
+        retry = Retry(total=retries, connect=retries, read=retries,
+                      status=retries, backoff_factor=self.backoff,
+                      status_forcelist=RETRY_STATUSES,
+                      allowed_methods=frozenset(["GET"]),
+                      raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size,
+                              max_retries=retry)
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        with self.lock:
+            self._adapters.append(adapter)
+        return session
+
+    def stats(self):
+        """Returns connection pool counters for the current process."""
+        opened = 0
+        requested = 0
+        with self.lock:
+            adapters = list(self._adapters) if self._pid == os.getpid() else []
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                opened += pool.num_connections
+                requested += pool.num_requests
+        return {
+            "sessions": len(adapters),
+            "requests": requested,
+            "connections_opened": opened,
+            "connections_reused": max(requested - opened, 0)
+        }
+
+
+class CircuitBreaker:
+    """Fails fast while an upstream is down.
+
+    After failure_threshold failures in a row the breaker opens, and calls
+    fail without being made. Once reset_timeout seconds pass, one call is
+    let through as a probe: if it succeeds the breaker closes, otherwise it
+    opens again.
+    """
+    def __init__(self, name, failure_threshold=5, reset_timeout=30):
+        self.name = name
+        self.failure_threshold = int(failure_threshold)
+        self.reset_timeout = float(reset_timeout)
+
+        self.lock = threading.Lock()
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.opened = 0
+        self.rejected = 0
+
+    def check(self):
+        """Raises CircuitOpenError unless a call may be made."""
+        with self.lock:
+            if self.state == CLOSED:
+                return
+            if (self.state == OPEN and
+                    time.monotonic() - self.opened_at >= self.reset_timeout):
+                self.state = HALF_OPEN
+                return  # this call is the probe
+            self.rejected += 1
+        raise CircuitOpenError("{} is unavailable".format(self.name))
+
+    def success(self):
+        with self.lock:
+            self.state = CLOSED
+            self.failures = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if (self.state == HALF_OPEN or
+                    self.failures >= self.failure_threshold):
+                if self.state != OPEN:
+                    self.opened += 1
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+
+    def inconclusive(self):
+        """Records a call which failed for reasons of our own, such as
+        running out of time. A probe which is inconclusive lets the next
+        call probe again."""
+        with self.lock:
+            if self.state == HALF_OPEN:
+                self.state = OPEN
+                self.opened_at = time.monotonic() - self.reset_timeout
+
+    def stats(self):
+        """Returns a dict of the breaker's state and counters."""
+        with self.lock:
+            return {
+                "state": self.state,
+                "opened": self.opened,
+                "rejected": self.rejected
+            }
@@ -0,0 +1,36 @@
+import zlib
+
+
+def shard_of(subreddit, count):
+    """Returns the shard a subreddit belongs to out of count shards.
+
+    The hash is stable across processes and hosts, unlike hash().
+    """
+    return zlib.crc32(subreddit.lower().encode("utf8")) % count
+
+
+def assign(subreddits, count):
+    """Splits subreddits into count shards.
+
+    Returns a dict from shard index to the subreddits in that shard, joined
+    into one multireddit name. Shards without subreddits are left out.
+    Entries which are multireddits themselves, like osugame+osucommunity,
+    stay together.
+    """
+    shards = {}
+    for subreddit in subreddits:
+        shards.setdefault(shard_of(subreddit, count), []).append(subreddit)
+    return {index: "+".join(names) for index, names in shards.items()}
+
+
+def parse_indices(string, count):
+    """Parses a comma separated list of shard indices, where an empty
+    string means every shard."""
+    if not string.strip():
+        return list(range(count))
+    indices = [int(part) for part in string.split(",")]
+    for index in indices:
+        if not 0 <= index < count:
+            raise ValueError("shard {} is not below count {}"
+                             .format(index, count))
+    return indices
@@ -1,4 +1,8 @@
 import configparser as cp
+import itertools
+import queue
+import threading
+import time
 from collections import deque
 
 
@@ -43,6 +47,118 @@ class LimitedSet(set):
         self.queue.clear()
 
 
+class SeenStore:
+    """A LimitedSet kept in a database.
+
+    Stores with the same name share their keys, across processes and
+    restarts of the bot. The most recent keys are mirrored in memory, so
+    most lookups don't touch the database.
+    """
+    # Keys beyond maxlen are deleted after this many additions.
+    TRIM_EVERY = 100
+
+    def __init__(self, db, name, maxlen):
+        self.db = db
+        self.name = name
+        self.maxlen = maxlen
+        self.added = 0
+
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen ("
+                        "seq INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "name TEXT NOT NULL, "
+                        "key TEXT NOT NULL, "
+                        "UNIQUE (name, key))")
+        self.db.execute("CREATE INDEX IF NOT EXISTS seen_name_seq "
+                        "ON seen (name, seq)")
+        rows = self.db.execute("SELECT key FROM seen WHERE name = ? "
+                               "ORDER BY seq DESC LIMIT ?", (name, maxlen))
+        self.recent = LimitedSet(maxlen, [key for key, in reversed(rows)])
+
+    def __contains__(self, key):
+        if key in self.recent:
+            return True
+        # Another process may have added it.
+        rows = self.db.execute("SELECT 1 FROM seen WHERE name = ? AND key = ?",
+                               (self.name, key))
+        if rows:
+            self.recent.add(key)
+        return bool(rows)
+
+    def __len__(self):
+        return len(self.recent)
+
+    def add(self, key):
+        if key in self.recent:
+            return
+        self.db.execute("INSERT OR IGNORE INTO seen (name, key) VALUES (?, ?)",
+                        (self.name, key))
+        self.recent.add(key)
+        self.added += 1
+        if self.added % self.TRIM_EVERY == 0:
+            self.trim()
+
+    def trim(self):
+        """Deletes all but the newest maxlen keys from the database."""
+        self.db.execute("DELETE FROM seen WHERE name = ? AND seq <= ("
+                        "SELECT seq FROM seen WHERE name = ? "
+                        "ORDER BY seq DESC LIMIT 1 OFFSET ?)",
+                        (self.name, self.name, self.maxlen))
+
+
+class IntakeQueue:
+    """A bounded queue of work, cheapest first.
+
+    Items are ordered by their cost, then by when they were put. Keys of
+    items queued or being worked on are kept, so an item put again in the
+    meantime isn't worked on twice at once.
+    """
+    def __init__(self, maxsize=0):
+        self.queue = queue.PriorityQueue(maxsize)
+        self.lock = threading.Lock()
+        self.order = itertools.count()
+        self.queued = {}  # key -> time put
+        self.active = set()
+
+    def put(self, key, cost, item):
+        """Queues an item, blocking while the queue is full.
+
+        Returns False without queueing it if key is already queued or being
+        worked on.
+        """
+        with self.lock:
+            if key in self.queued or key in self.active:
+                return False
+            self.queued[key] = time.monotonic()
+        self.queue.put((cost, next(self.order), key, item))
+        return True
+
+    def get(self):
+        """Returns the key and item of the cheapest item and the seconds it
+        waited for, blocking until there is one."""
+        _, _, key, item = self.queue.get()
+        with self.lock:
+            put_at = self.queued.pop(key)
+            self.active.add(key)
+        return key, item, time.monotonic() - put_at
+
+    def done(self, key):
+        """Marks the item of key as worked on."""
+        with self.lock:
+            self.active.discard(key)
+
+    def stats(self):
+        """Returns a dict of the queue's depth and the age of its oldest
+        item."""
+        now = time.monotonic()
+        with self.lock:
+            oldest = min(self.queued.values(), default=now)
+            return {
+                "depth": len(self.queued),
+                "active": len(self.active),
+                "oldest_age": now - oldest
+            }
+
+
 class ConfigParser(cp.ConfigParser):
     """A space-aware ConfigParser.
 
@@ -0,0 +1,85 @@
+import multiprocessing as mp
+import multiprocessing.connection as mpc
+import time
+
+from .metrics import Registry
+
+
+class Supervisor:
+    """Keeps worker processes running, restarting each one that stops.
+
+    Workers are forked from the supervising process, so they start with
+    everything it has already imported and set up. A worker which stops
+    within healthy_after seconds of starting waits twice as long as it did
+    last time before being restarted, up to max_delay seconds.
+    """
+    def __init__(self, min_delay=1, max_delay=60, healthy_after=60):
+        self.min_delay = float(min_delay)
+        self.max_delay = float(max_delay)
+        self.healthy_after = float(healthy_after)
+        # Other start methods import everything again in each worker.
+        self.context = mp.get_context("fork")
+        self.workers = {}
+        # Kept apart from the global registry, which workers inherit.
+        self.registry = Registry()
+
+    def add(self, name, target, args=()):
+        self.workers[name] = {
+            "target": target,
+            "args": args,
+            "process": None,
+            "started": 0.0,
+            "delay": 0.0,
+            "restart_at": 0.0
+        }
+
+    def run(self, interval=None, tick=None):
+        """Supervises the workers forever, calling tick about every interval
+        seconds."""
+        while True:
+            now = time.monotonic()
+            for name, worker in self.workers.items():
+                if worker["process"] is None and worker["restart_at"] <= now:
+                    self.start(name, worker)
+
+            timeout = interval
+            for worker in self.workers.values():
+                if worker["process"] is None:
+                    wait = max(worker["restart_at"] - now, 0)
+                    timeout = wait if timeout is None else min(timeout, wait)
+            by_sentinel = {worker["process"].sentinel: name
+                           for name, worker in self.workers.items()
+                           if worker["process"] is not None}
+            for sentinel in mpc.wait(list(by_sentinel), timeout):
+                self.stopped(by_sentinel[sentinel])
+            if tick is not None:
+                tick()
+
+    def start(self, name, worker):
+        process = self.context.Process(target=worker["target"],
+                                       args=worker["args"], daemon=True)
+        process.start()
+        worker["process"] = process
+        worker["started"] = time.monotonic()
+
+    def stopped(self, name):
+        worker = self.workers[name]
+        worker["process"].join()
+        exitcode = worker["process"].exitcode
+        worker["process"] = None
+
+        now = time.monotonic()
+        if now - worker["started"] >= self.healthy_after:
+            worker["delay"] = self.min_delay
+        else:
+            worker["delay"] = min(max(worker["delay"] * 2, self.min_delay),
+                                  self.max_delay)
+        worker["restart_at"] = now + worker["delay"]
+        self.registry.inc("worker_restarts_total", worker=name)
+        print("Worker {} stopped with exit code {}, restarting in {:.0f} "
+              "seconds.".format(name, exitcode, worker["delay"]))
+
+    def terminate(self):
+        for worker in self.workers.values():
+            if worker["process"] is not None:
+                worker["process"].terminate()
@@ -1,4 +1,7 @@
-import requests
+from .cache import SingleFlight
+from .metrics import REGISTRY
+from .ratelimit import RateLimitTimeout, TokenBucket
+from .session import CircuitBreaker, CircuitOpenError, Session
 
 API_URL = "https://api.tillerino.org/beatmapinfo"
 DEFAULT_API_KEY = "00000000000000000000000000000000"
@@ -8,38 +11,97 @@ ALLOWED_APPROVED = {"2", "1"}
 
 class Tillerino:
     """A Tillerino API wrapper."""
-    def __init__(self, api_key=DEFAULT_API_KEY, wait=1000):
+    def __init__(self, api_key=DEFAULT_API_KEY, wait=1000, connect_timeout=5,
+                 read_timeout=15, retries=2, backoff=0.5, cache=None,
+                 ttl=2592000, negative_ttl=600, rate=0, burst=1,
+                 failure_threshold=5, reset_timeout=30, api_url=API_URL):
         self.api_key = api_key
+        self.api_url = api_url
         self.wait = wait
+        self.session = Session(connect_timeout, read_timeout, retries,
+                               backoff)
+        self.cache = cache
+        self.ttl = int(ttl)
+        self.negative_ttl = int(negative_ttl)
+        self.flights = SingleFlight()
+        self.limiter = None
+        if float(rate) > 0:
+            self.limiter = TokenBucket(rate, burst)
+        self.breaker = CircuitBreaker("Tillerino", failure_threshold,
+                                      reset_timeout)
 
-    def get_pp_info(self, map_info):
-        """Gets PP info about a specific beatmap."""
+    def get_pp_info(self, map_info, priority=0, within=None):
+        """Gets PP info about a specific beatmap, giving up on Tillerino
+        after within seconds."""
         if self.api_key == DEFAULT_API_KEY or len(map_info) != 1:
             return {}
 
-        map_dict = map_info[0]
+        beatmap = map_info.first
 
-        if (map_dict["mode"] not in ALLOWED_MODES or
-                map_dict["approved"] not in ALLOWED_APPROVED):
+        if (beatmap.mode not in ALLOWED_MODES or
+                beatmap.approved not in ALLOWED_APPROVED):
             return {}
 
+        beatmap_id = beatmap.beatmap_id
+        if self.cache is not None:
+            out = self.cache.get((beatmap_id,))
+            if out is not None:
+                return out
+        return self.flights.do(
+            beatmap_id,
+            lambda: self.fetch_pp_info(beatmap_id, priority, within))
+
+    def fetch_pp_info(self, beatmap_id, priority=0, within=None):
+        """Requests PP info about a beatmap id from Tillerino.
+
+        Results are cached, as are failures for a short time so maps
+        Tillerino hasn't computed yet don't make us wait every time. While
+        Tillerino is down, no pp info is returned without asking.
+        """
+        try:
+            self.breaker.check()
+        except CircuitOpenError:
+            return {}
         payload = {
             "k": self.api_key,
             "wait": self.wait,
-            "beatmapid": map_dict["beatmap_id"]
+            "beatmapid": beatmap_id
         }
+        if self.limiter is not None:
+            try:
+                within = self.limiter.acquire(priority, within)
+            except RateLimitTimeout:
+                self.breaker.inconclusive()
+                return {}
         try:
-            r = requests.get(API_URL, params=payload)
+            r = self.session.get(self.api_url, within, params=payload)
         except Exception as e:
+            if self.session.shortened(within):
+                self.breaker.inconclusive()
+            else:
+                self.breaker.failure()
             print("tillerino:", e)
+            REGISTRY.inc("api_errors_total", api="tillerino",
+                         type=type(e).__name__)
             return {}
+        # Tillerino answers 404 for maps it hasn't computed yet.
+        if r.status_code >= 500:
+            self.breaker.failure()
+        else:
+            self.breaker.success()
         if r.status_code != 200:
+            REGISTRY.inc("api_errors_total", api="tillerino",
+                         type="http_{}".format(r.status_code))
             print(r.status_code, "occurred when getting pp data for",
-                  map_dict["beatmap_id"])
+                  beatmap_id)
+            if self.cache is not None:
+                self.cache.set((beatmap_id,), {}, self.negative_ttl)
             return {}
 
         # Tillerino returns a in a weird format, so let's convert that to a
         # dictionary to make our lives easier
         key_value_list = r.json()["ppForAcc"]["entry"]
         output_dict = {str(d["key"]): d["value"] for d in key_value_list}
+        if self.cache is not None:
+            self.cache.set((beatmap_id,), output_dict, self.ttl)
         return output_dict
@@ -0,0 +1,207 @@
+"""Offline micro-benchmarks for BeatmapLinker's hot paths.
+
+Run from the repository root:
+
+    python -m benchmarks.bench
+    python -m benchmarks.bench --save baseline.json
+    python -m benchmarks.bench --compare baseline.json
+
+Benchmarks run against the recorded comment HTML and API responses in
+benchmarks/fixtures, so no network access or API keys are needed.
+"""
+import argparse
+import html
+import json
+import os
+import sys
+import time
+import tracemalloc
+from itertools import cycle, islice
+
+from beatmaplinker import beatmap, format, parse
+from beatmaplinker import helpers as h
+from beatmaplinker.beatmap import Mapset
+from beatmaplinker.structs import ConfigParser, LimitedSet
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES = os.path.join(ROOT, "benchmarks", "fixtures")
+
+
+def fixture(name):
+    with open(os.path.join(FIXTURES, name), encoding="utf8") as f:
+        return f.read()
+
+
+def load_responses():
+    """Returns the recorded get_beatmaps and Tillerino responses.
+
+    Tillerino responses are converted to what Tillerino.get_pp_info returns.
+    """
+    beatmaps = json.loads(fixture("get_beatmaps.json"))
+    pp = {}
+    for beatmap_id, response in json.loads(fixture("tillerino.json")).items():
+        pp[beatmap_id] = {str(d["key"]): d["value"]
+                          for d in response["ppForAcc"]["entry"]}
+    return beatmaps, pp
+
+
+def make_formatter():
+    config = ConfigParser()
+    with open(os.path.join(ROOT, "config_default.ini"), encoding="utf8") as c:
+        config.read_file(c)
+    replacements = ConfigParser()
+    with open(os.path.join(ROOT, "replacements_default.ini"),
+              encoding="utf8") as r:
+        replacements.read_file(r)
+    return format.Formatter(replacements, **config["template"])
+
+
+def get_benchmarks():
+    """Returns a list of (name, function) pairs to benchmark."""
+    htmls = {
+        "short": fixture("comment_short.html"),
+        "mapping_list": fixture("mapping_list.html"),
+        "wall_of_text": fixture("wall_of_text.html")
+    }
+    urls = parse.get_links_from_html(htmls["mapping_list"])
+    beatmaps, pp = load_responses()
+    formatter = make_formatter()
+
+    # Cycle through the recorded maps to get posts of any size.
+    extra_fields = beatmap.extra_fields(formatter.fields)
+    mapsets = [Mapset.from_response(info, extra_fields)
+               for _, info in sorted(beatmaps.items())]
+    recorded = [(info, pp.get(info.first.beatmap_id, {}) if len(info) == 1
+                 else {}) for info in mapsets]
+
+    find_maps = h.compose(
+        parse.get_links_from_html,
+        h.mapf(parse.get_map_params),
+        h.truthies,
+        h.remove_dups
+    )
+
+    benchmarks = []
+    for name, body in htmls.items():
+        raw = html.escape(body, quote=False)
+        benchmarks.append(("get_links_from_html[{}]".format(name),
+                           lambda body=body: parse.get_links_from_html(body)))
+        benchmarks.append(("compose_pipeline[{}]".format(name),
+                           lambda body=body: list(find_maps(body))))
+        benchmarks.append(("get_maps_from_html[{}]".format(name),
+                           lambda body=body: parse.get_maps_from_html(body)))
+        benchmarks.append(("get_maps_from_raw_html[{}]".format(name),
+                           lambda raw=raw: parse.get_maps_from_raw_html(raw)))
+    benchmarks.append(("get_map_params[{} urls]".format(len(urls)),
+                       lambda: [parse.get_map_params(url) for url in urls]))
+
+    for n in [1, 10, 300]:
+        maps = list(islice(cycle(recorded), n))
+        map_infos = [info for info, _ in maps]
+        pp_infos = [pp_info for _, pp_info in maps]
+        strings = formatter.format_maps(map_infos, pp_infos)
+        benchmarks.append((
+            "format_map[{} maps]".format(n),
+            lambda m=map_infos, p=pp_infos: list(map(formatter.format_map,
+                                                     m, p))))
+        benchmarks.append((
+            "format_comments[{} maps]".format(n),
+            lambda s=strings: formatter.format_comments(s)))
+
+    ids = ["dk{:05}".format(i) for i in range(10000)]
+
+    def limited_set_churn():
+        seen = LimitedSet(300)
+        for thing_id in ids:
+            if thing_id not in seen:
+                seen.add(thing_id)
+    benchmarks.append(("LimitedSet.add[10000 into 300]", limited_set_churn))
+    return benchmarks
+
+
+def measure(func, min_time=0.2, repeat=5):
+    """Returns the best ops/sec of func and the peak bytes one call
+    allocates."""
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_time:
+            break
+        number *= 2
+
+    best = elapsed
+    for _ in range(repeat - 1):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        func()
+        peak = tracemalloc.get_traced_memory()[1] - base
+    finally:
+        tracemalloc.stop()
+    return number / best, peak
+
+
+def compare(results, baseline, tolerance):
+    """Prints how results compare to a baseline and returns the names of
+    benchmarks which regressed by more than tolerance."""
+    regressions = []
+    print()
+    print("{:<40} {:>14} {:>14} {:>8}".format(
+        "benchmark", "baseline op/s", "current op/s", "change"))
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        before = baseline[name]["ops"]
+        change = result["ops"] / before - 1
+        flag = ""
+        if change < -tolerance:
+            regressions.append(name)
+            flag = "  REGRESSED"
+        print("{:<40} {:>14.1f} {:>14.1f} {:>+7.1%}{}".format(
+            name, before, result["ops"], change, flag))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("-k", "--filter", default="",
+                        help="only run benchmarks whose name contains this")
+    parser.add_argument("--save", metavar="FILE",
+                        help="save results as a baseline")
+    parser.add_argument("--compare", metavar="FILE",
+                        help="compare results against a saved baseline")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="fraction slower than the baseline allowed "
+                             "before a benchmark counts as regressed")
+    args = parser.parse_args(argv)
+
+    results = {}
+    print("{:<40} {:>14} {:>12}".format("benchmark", "op/s", "peak KiB"))
+    for name, func in get_benchmarks():
+        if args.filter not in name:
+            continue
+        ops, peak = measure(func)
+        results[name] = {"ops": ops, "peak_bytes": peak}
+        print("{:<40} {:>14.1f} {:>12.1f}".format(name, ops, peak / 1024))
+
+    if args.save:
+        with open(args.save, "w", encoding="utf8") as f:
+            json.dump(results, f, indent=1, sort_keys=True)
+    if args.compare:
+        with open(args.compare, encoding="utf8") as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Local stand-ins for reddit and the osu! and Tillerino APIs."""
+import html
+import json
+import queue
+import random
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import praw
+
+from .bench import load_responses
+
+
+class FakeApiServer:
+    """Serves get_beatmaps and Tillerino beatmapinfo from recorded responses.
+
+    Maps not in the recordings are made up from them, so any id works.
+    Each request waits about latency seconds, and fails with probability
+    error_rate.
+    """
+    def __init__(self, latency=0.05, jitter=0.5, error_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.beatmaps, self.pp = load_responses()
+        self.templates = [info[0]
+                          for key, info in sorted(self.beatmaps.items())
+                          if key.startswith("b:")]
+        self.lock = threading.Lock()
+        self.requests = {"osu": 0, "tillerino": 0}
+        self.errors = {"osu": 0, "tillerino": 0}
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                server.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{}".format(self.httpd.server_address[1])
+
+    @property
+    def osu_url(self):
+        return self.url + "/api/get_beatmaps"
+
+    @property
+    def tillerino_url(self):
+        return self.url + "/beatmapinfo"
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def handle(self, request):
+        parsed = urllib.parse.urlparse(request.path)
+        query = dict(urllib.parse.parse_qsl(parsed.query))
+        api = "osu" if parsed.path == "/api/get_beatmaps" else "tillerino"
+        with self.lock:
+            self.requests[api] += 1
+            failed = self.random.random() < self.error_rate
+            delay = self.latency * (1 + self.jitter *
+                                    (2 * self.random.random() - 1))
+            if failed:
+                self.errors[api] += 1
+        time.sleep(max(delay, 0))
+
+        if api == "osu":
+            if failed:
+                status, body = 200, {"error": "injected failure"}
+            else:
+                status, body = 200, self.get_beatmaps(query)
+        elif failed:
+            status, body = 500, {}
+        else:
+            status, body = self.beatmapinfo(query.get("beatmapid", ""))
+
+        data = json.dumps(body).encode("utf8")
+        request.send_response(status)
+        request.send_header("Content-Type", "application/json")
+        request.send_header("Content-Length", str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+    def get_beatmaps(self, query):
+        if "b" in query:
+            key, map_id = "b:" + query["b"], query["b"]
+        else:
+            key, map_id = "s:" + query.get("s", ""), query.get("s", "")
+        if key in self.beatmaps:
+            return self.beatmaps[key]
+        if not map_id.isdigit():
+            return []
+
+        template = self.templates[int(map_id) % len(self.templates)]
+        if key.startswith("b:"):
+            return [dict(template, beatmap_id=map_id)]
+        return [dict(template, beatmapset_id=map_id,
+                     beatmap_id=str(int(map_id) * 10 + i),
+                     version="Diff {}".format(i))
+                for i in range(1 + int(map_id) % 6)]
+
+    def beatmapinfo(self, beatmap_id):
+        if beatmap_id in self.pp:
+            pp = self.pp[beatmap_id]
+        elif beatmap_id.isdigit() and int(beatmap_id) % 5:
+            top = 100 + int(beatmap_id) % 500
+            pp = {"0.95": top * 0.8, "0.98": top * 0.9, "0.99": top * 0.95,
+                  "1.0": top}
+        else:
+            return 404, {}  # not computed yet
+        entries = [{"key": float(k), "value": v} for k, v in pp.items()]
+        return 200, {"ppForAcc": {"entry": entries}}
+
+
+def make_comment(thing_id, body):
+    """Creates a praw Comment from inner comment HTML, without a reddit
+    instance."""
+    escaped = html.escape('<div class="md">' + body + "</div>", quote=False)
+    return praw.models.Comment(None, _data={
+        "id": thing_id,
+        "body_html": escaped,
+        "created_utc": time.time()
+    })
+
+
+def link(map_tuple):
+    url = "https://osu.ppy.sh/{}/{}".format(*map_tuple)
+    return '<a href="{0}">{0}</a>'.format(url)
+
+
+class FakeReddit:
+    """Stands in for beatmaplinker.reddit.Reddit, recording replies.
+
+    Things put in the things queue come out of the comment stream.
+    """
+    ledger = None
+
+    def __init__(self, things, reply_latency=0.0):
+        self.things = things
+        self.reply_latency = reply_latency
+        self.lock = threading.Lock()
+        # (thing, time of the first comment, time of the last, texts)
+        self.replies = []
+
+    def build_ledger(self, limit):
+        pass
+
+    def adopt(self, thing):
+        return thing
+
+    def has_replied(self, t):
+        return False
+
+    def reply(self, thing, texts):
+        posted = []
+        first = None
+        for text in texts:
+            time.sleep(self.reply_latency)
+            posted.append(text)
+            if first is None:
+                first = time.perf_counter()
+        with self.lock:
+            self.replies.append((thing, first, time.perf_counter(), posted))
+        return True
+
+    def get_comment_stream(self, pause_after=None):
+        while True:
+            try:
+                yield self.things.get(timeout=0.1)
+            except queue.Empty:
+                if pause_after is not None:
+                    yield None
+
+    def get_submission_stream(self, pause_after=None):
+        while True:
+            if pause_after is not None:
+                yield None
+            else:
+                time.sleep(1)
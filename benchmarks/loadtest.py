@@ -0,0 +1,261 @@
+"""End-to-end load test of Bot against local stand-in services.
+
+Run from the repository root:
+
+    python -m benchmarks.loadtest --rate 5 --duration 30
+    python -m benchmarks.loadtest --runtime async --latency 0.2 --errors 0.02
+    python -m benchmarks.loadtest --find-max
+
+Synthetic comments are fed to the bot at a fixed rate, with the number of
+maps in each drawn from --maps. The osu! API and Tillerino are served
+locally with injected latency and errors, and replies go to a fake reddit.
+"""
+import argparse
+import asyncio
+import queue
+import random
+import threading
+import time
+
+import bot
+from beatmaplinker.structs import ConfigParser
+
+from .fakes import FakeApiServer, FakeReddit, link, make_comment
+
+RUNTIMES = ["process", "stream", "async"]
+
+
+def parse_distribution(string):
+    """Parses "count:weight,..." into a list of counts and of weights."""
+    counts, weights = [], []
+    for part in string.split(","):
+        count, weight = part.split(":")
+        counts.append(int(count))
+        weights.append(float(weight))
+    return counts, weights
+
+
+class LoadBot(bot.Bot):
+    """A Bot using a fake reddit, which records when it's done with things."""
+    def __init__(self, config, replace, fake_reddit):
+        self.fake_reddit = fake_reddit
+        self.lock = threading.Lock()
+        self.done = {}  # thing id -> time processed
+        self.failed = 0
+        super().__init__(config, replace)
+
+    def get_new_reddit(self, subreddit=None):
+        return self.fake_reddit
+
+    def finish(self, thing, failed):
+        with self.lock:
+            self.done[thing.id] = time.perf_counter()
+            self.failed += failed
+
+    def process_content(self, thing_type, thing, seen, reddit_instance,
+                        found=None):
+        failed = True
+        try:
+            super().process_content(thing_type, thing, seen, reddit_instance,
+                                    found)
+            failed = False
+        finally:
+            self.finish(thing, failed)
+
+    async def process_content_async(self, thing_type, thing, seen, replies,
+                                    reddit_executor):
+        failed = True
+        try:
+            await super().process_content_async(thing_type, thing, seen,
+                                                replies, reddit_executor)
+            failed = False
+        finally:
+            self.finish(thing, failed)
+
+
+def make_config(server, args):
+    config = ConfigParser()
+    with open("config_default.ini", encoding="utf8") as c:
+        config.read_file(c)
+    config.read_dict({
+        "bot": {"ledger_path": "", "seen_path": "", "outbox_path": "",
+                "fetch_workers": str(args.fetch_workers),
+                "runtime": args.runtime,
+                "stream_replies": str(args.stream_replies),
+                "stream_workers": str(args.stream_workers)},
+        "reddit": {"username": "BeatmapLinker", "password": "",
+                   "client_id": "", "client_secret": ""},
+        "osu": {"api_key": "0" * 40, "api_url": server.osu_url},
+        "tillerino": {"api_key": "1" * 32, "api_url": server.tillerino_url},
+        "cache": {"path": ""},
+        "metrics": {"dir": args.metrics_dir, "interval": "1"}
+    })
+    return config
+
+
+def make_replacements():
+    replacements = ConfigParser()
+    with open("replacements_default.ini", encoding="utf8") as r:
+        replacements.read_file(r)
+    return replacements
+
+
+def generate(args, rate, rng):
+    """Yields (due time, comment) at rate comments per second.
+
+    Latency is measured from when a comment was due, so time spent waiting
+    for the bot to take it counts.
+    """
+    counts, weights = parse_distribution(args.maps)
+    total = int(rate * args.duration)
+    start = time.perf_counter()
+    for i in range(total):
+        n = rng.choices(counts, weights)[0]
+        maps = [(rng.choice("bs"), str(rng.randrange(1, args.unique_maps)))
+                for _ in range(n)]
+        body = "<p>comment {} ".format(i) + " ".join(map(link, maps)) + "</p>"
+        thing = make_comment("lt{:06}".format(i), body)
+        due = start + i / rate
+        delay = due - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        yield due, thing
+
+
+def run_trial(args, rate, server):
+    """Runs the bot at a rate, returning a dict of results."""
+    rng = random.Random(args.seed)
+    things = queue.Queue()
+    fake_reddit = FakeReddit(things, args.reply_latency)
+    load_bot = LoadBot(make_config(server, args), make_replacements(),
+                       fake_reddit)
+
+    if args.runtime == "stream":
+        threading.Thread(target=load_bot.scan_content_stream,
+                         args=("comment",), daemon=True).start()
+    elif args.runtime == "async":
+        threading.Thread(target=asyncio.run, args=(load_bot.scan_async(),),
+                         daemon=True).start()
+
+    emitted = {}
+    seen = set()
+    start = time.perf_counter()
+    for due, thing in generate(args, rate, rng):
+        emitted[thing.id] = due
+        if args.runtime == "process":
+            load_bot.process_content("comment", thing, seen, fake_reddit)
+        else:
+            things.put(thing)
+    offered_time = time.perf_counter() - start
+
+    deadline = time.perf_counter() + args.drain
+    while len(load_bot.done) < len(emitted):
+        if time.perf_counter() > deadline:
+            break
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+
+    with fake_reddit.lock:
+        latencies = sorted(replied - emitted[thing.id]
+                           for thing, _, replied, _ in fake_reddit.replies)
+        first_latencies = sorted(first - emitted[thing.id]
+                                 for thing, first, _, _ in fake_reddit.replies)
+    return {
+        "rate": rate,
+        "offered": len(emitted),
+        "offered_rate": len(emitted) / offered_time,
+        "processed": len(load_bot.done),
+        "failed": load_bot.failed,
+        "replies": len(latencies),
+        "throughput": len(load_bot.done) / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "first_p99": percentile(first_latencies, 0.99)
+    }
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+def report(result):
+    print("rate {rate:.2f}/s: {processed}/{offered} things processed "
+          "({failed} failed), {replies} replies, {throughput:.2f} things/s, "
+          "reply latency p50 {p50:.3f}s p95 {p95:.3f}s p99 {p99:.3f}s, "
+          "first comment p99 {first_p99:.3f}s".format(**result))
+
+
+def keeps_up(result, slo):
+    return (result["processed"] == result["offered"] and
+            not result["p99"] > slo)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--runtime", choices=RUNTIMES, default="process",
+                        help="process calls Bot.process_content directly, "
+                             "stream and async use the bot's runtimes")
+    parser.add_argument("--rate", type=float, default=2,
+                        help="comments per second")
+    parser.add_argument("--duration", type=float, default=20,
+                        help="seconds to send comments for")
+    parser.add_argument("--drain", type=float, default=60,
+                        help="seconds to wait for the bot to catch up")
+    parser.add_argument("--maps", default="0:90,1:6,2:2,5:1,40:0.5,300:0.1",
+                        help="distribution of maps per comment, as "
+                             "count:weight pairs")
+    parser.add_argument("--unique-maps", type=int, default=2000,
+                        help="number of distinct map ids linked")
+    parser.add_argument("--latency", type=float, default=0.1,
+                        help="mean seconds each API request takes")
+    parser.add_argument("--errors", type=float, default=0.0,
+                        help="fraction of API requests which fail")
+    parser.add_argument("--reply-latency", type=float, default=0.05,
+                        help="seconds each posted comment takes")
+    parser.add_argument("--fetch-workers", type=int, default=8)
+    parser.add_argument("--stream-workers", type=int, default=4,
+                        help="threads processing things in the stream "
+                             "runtime, or 0 to process them as they're read")
+    parser.add_argument("--stream-replies", action="store_true",
+                        help="post each comment of a reply once it's full")
+    parser.add_argument("--find-max", action="store_true",
+                        help="double the rate until the bot falls behind")
+    parser.add_argument("--slo", type=float, default=10,
+                        help="p99 reply latency in seconds the bot must "
+                             "stay under to keep up, for --find-max")
+    parser.add_argument("--metrics-dir", default="",
+                        help="directory to write the bot's metrics to")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    server = FakeApiServer(args.latency, error_rate=args.errors,
+                           seed=args.seed)
+    try:
+        if not args.find_max:
+            report(run_trial(args, args.rate, server))
+            return
+
+        rate = args.rate
+        best = None
+        while True:
+            result = run_trial(args, rate, server)
+            report(result)
+            if not keeps_up(result, args.slo):
+                break
+            best = rate
+            rate *= 2
+        if best is None:
+            print("The bot couldn't keep up with", args.rate, "things/s.")
+        else:
+            print("Maximum sustainable rate: between {:.2f} and {:.2f} "
+                  "things/s".format(best, best * 2))
+    finally:
+        server.close()
+        print("API requests:", server.requests, "errors:", server.errors)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""Startup benchmark: how long a new worker takes to process its first thing.
+
+Run from the repository root:
+
+    python -m benchmarks.startup
+    python -m benchmarks.startup --trials 10
+
+A fresh interpreter, which has to import and set everything up itself, is
+compared against a worker forked from a process which already has a Bot, as
+the stream runtime starts its workers.
+"""
+import argparse
+import multiprocessing as mp
+import queue
+import statistics
+import subprocess
+import sys
+import time
+
+
+def make_bot(osu_url, tillerino_url):
+    # Imported here so a fresh interpreter's time includes the imports.
+    from .fakes import FakeReddit
+    from .loadtest import LoadBot, make_config, make_replacements
+
+    server = argparse.Namespace(osu_url=osu_url, tillerino_url=tillerino_url)
+    args = argparse.Namespace(fetch_workers=1, runtime="stream",
+                              stream_replies=False, stream_workers=0,
+                              metrics_dir="")
+    return LoadBot(make_config(server, args), make_replacements(),
+                   FakeReddit(queue.Queue()))
+
+
+def process_first_thing(load_bot, map_id):
+    """Processes one thing linking a map, as a new worker would."""
+    from .fakes import link, make_comment
+
+    thing = make_comment("st{}".format(map_id),
+                         "<p>{}</p>".format(link(("b", str(map_id)))))
+    load_bot.process_content("comment", thing, set(), load_bot.fake_reddit)
+
+
+def cold_child(osu_url, tillerino_url, map_id):
+    process_first_thing(make_bot(osu_url, tillerino_url), map_id)
+    print(time.time())
+
+
+def cold_trial(server, map_id):
+    start = time.time()
+    out = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child",
+         server.osu_url, server.tillerino_url, str(map_id)],
+        check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return float(out.split()[-1]) - start
+
+
+def warm_child(load_bot, map_id, conn):
+    process_first_thing(load_bot, map_id)
+    conn.send(time.time())
+
+
+def warm_trial(load_bot, map_id):
+    context = mp.get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    start = time.time()
+    process = context.Process(target=warm_child,
+                              args=(load_bot, map_id, sender))
+    process.start()
+    finished = receiver.recv()
+    process.join()
+    return finished - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--trials", type=int, default=5)
+    parser.add_argument("--child", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        cold_child(*args.child)
+        return
+
+    from .fakes import FakeApiServer
+
+    server = FakeApiServer(latency=0.0, jitter=0.0)
+    try:
+        load_bot = make_bot(server.osu_url, server.tillerino_url)
+        # Warm up the process being forked from, as a running bot would be.
+        process_first_thing(load_bot, 1)
+        results = {"fresh interpreter": [], "forked from warm process": []}
+        for i in range(args.trials):
+            results["fresh interpreter"].append(cold_trial(server, 1000 + i))
+            results["forked from warm process"].append(
+                warm_trial(load_bot, 2000 + i))
+    finally:
+        server.close()
+
+    print("{:<28} {:>10} {:>10}".format("time to first thing", "median",
+                                        "max"))
+    for name, times in results.items():
+        print("{:<28} {:>9.3f}s {:>9.3f}s".format(
+            name, statistics.median(times), max(times)))
+
+
+if __name__ == "__main__":
+    main()
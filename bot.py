@@ -1,29 +1,114 @@
+import argparse
+import asyncio
+import atexit
+import contextlib
+import functools
+import json
 import multiprocessing as mp
-import multiprocessing.connection as mpc
+import os
+import shutil
 import sys
+import tempfile
+import threading
 import time
-from beatmaplinker import format, osu, parse, reddit, tillerino
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait
+from itertools import chain
+from beatmaplinker import (batch, beatmap, cache, db, format, ledger, metrics,
+                           osu, outbox, parse, ratelimit, reddit, shard,
+                           tillerino)
+from beatmaplinker.supervisor import Supervisor
 from beatmaplinker import helpers as h
-from beatmaplinker.structs import LimitedSet, ConfigParser
+from beatmaplinker.structs import (ConfigParser, IntakeQueue, LimitedSet,
+                                   SeenStore)
+
+# Things linking more maps than this get a "too many maps" reply.
+MAX_MAPS = 300
+# Rate limited requests for the first maps of a thing are sent before those
+# of later maps, in groups of this many maps.
+MAPS_PER_PRIORITY = 10
+# Seconds past a thing's deadline to wait for requests timing out at it.
+DEADLINE_GRACE = 0.5
+
+
+class OutOfTime(Exception):
+    """Raised instead of fetching a map once a thing's time budget is up."""
 
 
 class Bot:
     def __init__(self, config, replace):
+        self.started = time.monotonic()
+        self.worker_started = self.started
+        self.replied_once = False
         try:
             self.config = config
-            # Note: this reddit instance may not be used!
-            self.reddit = self.get_new_reddit()
-            self.osu = osu.Osu(**config["osu"])
-            self.formatter = format.Formatter(replace, **config["template"])
-            self.tillerino = tillerino.Tillerino(**config["tillerino"])
-
             bot_sect = config["bot"]
+            self.ledger = None
+            if bot_sect["ledger_path"]:
+                self.ledger = ledger.ReplyLedger(
+                    db.Database(bot_sect["ledger_path"]))
+            self.ledger_history = int(bot_sect["ledger_history"])
+            # Each worker opens its own outbox when it starts posting.
+            self.outbox_db = None
+            if bot_sect.get("outbox_path"):
+                self.outbox_db = db.Database(bot_sect["outbox_path"])
+            self.outbox = None
+            self.shards = self.get_shards(config)
+            # Only made when first used, as the stream runtime's workers
+            # make their own.
+            self._reddit = None
+            cache_sect = config["cache"]
+            self.db = None
+            if cache_sect["path"]:
+                self.db = db.Database(cache_sect["path"])
+            self.formatter = format.Formatter(
+                replace,
+                cache=cache.Cache("rendered", cache_sect["size"]),
+                **config["template"])
+            # osu! API responses are kept as Mapsets of only the fields the
+            # templates use.
+            extra_fields = beatmap.extra_fields(self.formatter.fields)
+            self.osu = osu.Osu(
+                cache=cache.Cache("osu", cache_sect["size"], self.db,
+                                  encode=beatmap.encode,
+                                  decode=functools.partial(
+                                      beatmap.decode,
+                                      extra_fields=extra_fields)),
+                set_ids=cache.Cache("osu_sets", cache_sect["size"], self.db),
+                extra_fields=extra_fields,
+                **config["osu"])
+            self.tillerino = tillerino.Tillerino(
+                cache=cache.Cache("tillerino", cache_sect["size"], self.db),
+                **config["tillerino"])
+
+            self.seen_db = None
+            if bot_sect["seen_path"]:
+                self.seen_db = db.Database(bot_sect["seen_path"])
             self.max_comments = int(bot_sect["max_comments"])
-            self.seen_comments = LimitedSet(2 * self.max_comments)
+            self.seen_comments = self.new_seen("comment",
+                                               2 * self.max_comments)
             self.max_submissions = int(bot_sect["max_submissions"])
-            self.seen_submissions = LimitedSet(2 * self.max_submissions)
+            self.seen_submissions = self.new_seen("submission",
+                                                  2 * self.max_submissions)
             self.extra_delay = int(bot_sect.get("extra_delay", 0))
             self.meme = bot_sect.get("meme", None)
+            self.fetch_workers = int(bot_sect.get("fetch_workers", 1))
+            self.runtime = bot_sect.get("runtime", "stream")
+            self.async_workers = int(bot_sect.get("async_workers", 4))
+            self.restart_delay = float(bot_sect.get("restart_delay", 1))
+            self.max_restart_delay = float(
+                bot_sect.get("max_restart_delay", 60))
+            self.stream_replies = bot_sect.getboolean("stream_replies",
+                                                      False)
+            self.thing_budget = float(bot_sect.get("thing_budget", 0)) or None
+            self.stream_workers = int(bot_sect.get("stream_workers", 0))
+            self.intake_size = int(bot_sect.get("intake_size", 100))
+
+            metrics_sect = config["metrics"]
+            self.metrics_dir = metrics_sect["dir"]
+            self.metrics_interval = float(metrics_sect["interval"])
+            metrics.REGISTRY.add_collector(self.collect_metrics)
+            self._fetch_pool = None
+            self._fetch_pool_pid = None
         except Exception as e:
             print("We had an exception when parsing the config.")
             print("Have you configured config.ini correctly?")
@@ -31,8 +116,81 @@ class Bot:
             print(e)
             sys.exit()
 
-    def get_new_reddit(self):
-        return reddit.Reddit(**self.config["reddit"])
+    @property
+    def reddit(self):
+        if self._reddit is None:
+            self._reddit = self.get_new_reddit()
+        return self._reddit
+
+    def get_new_reddit(self, subreddit=None):
+        """Returns a new reddit instance streaming from subreddit, or from
+        the subreddits of every shard run here."""
+        if subreddit is None:
+            subreddit = "+".join(self.shards.values())
+        return reddit.Reddit(ledger=self.ledger, outbox=self.outbox,
+                             **dict(self.config["reddit"],
+                                    subreddit=subreddit))
+
+    def get_shards(self, config):
+        """Returns a dict from the index of each shard run here to its
+        subreddits, joined into one multireddit name."""
+        shard_sect = config["shard"]
+        subreddits = [name.strip()
+                      for name in shard_sect["subreddits"].split(",")
+                      if name.strip()]
+        if not subreddits:
+            return {0: config["reddit"]["subreddit"]}
+        count = int(shard_sect["count"])
+        assigned = shard.assign(subreddits, count)
+        shards = {index: assigned[index]
+                  for index in shard.parse_indices(shard_sect["run"], count)
+                  if index in assigned}
+        if not shards:
+            raise Exception("None of the shards run here have subreddits.")
+        return shards
+
+    def worker_name(self, thing_type, index):
+        if len(self.shards) == 1:
+            return thing_type
+        return "{}-{}".format(thing_type, index)
+
+    def new_seen(self, name, maxlen):
+        """Returns a set of the ids of things we're done with.
+
+        With a seen_path, sets of the same name are shared by every process
+        and kept across restarts.
+        """
+        if self.seen_db is None:
+            return LimitedSet(maxlen)
+        return SeenStore(self.seen_db, name, maxlen)
+
+    def start_poster(self, worker):
+        """Starts a thread posting this worker's replies from the outbox, if
+        there is one, first posting what it hadn't when it last stopped."""
+        if self.outbox_db is None:
+            return
+        self.outbox = outbox.Outbox(self.outbox_db, worker)
+        self.outbox.recover()
+        threading.Thread(target=self.run_poster, daemon=True).start()
+
+    def run_poster(self):
+        """Runs a reddit instance's post_queued, forever, restarting it with
+        a new instance if it stops."""
+        while True:
+            try:
+                self.get_new_reddit().post_queued()
+            except Exception as e:
+                print("The poster caught an exception:")
+                print(e)
+            print("Restarting the poster in 15 seconds.")
+            time.sleep(15)
+
+    def build_ledger(self, reddit_instance):
+        try:
+            reddit_instance.build_ledger(self.ledger_history)
+        except Exception as e:
+            print("Couldn't build the reply ledger, falling back to reddit:")
+            print(e)
 
     def scan_content(self, thing_type, content, seen, reddit_instance=None):
         """Scans content for new things to reply to."""
@@ -42,12 +200,14 @@ class Bot:
         for thing in content:
             self.process_content(thing_type, thing, seen, reddit_instance)
 
-    def scan_content_stream(self, thing_type):
+    def scan_content_stream(self, thing_type, index=None):
         """
         Scans content using PRAW streams and catch errors.
         This is better than scan_loop as PRAW has its own optimisations to
         reduce network / CPU usage, see
         https://github.com/praw-dev/praw/blob/ceb8acde155af72b98adbac7b2fc3aa9f596bb9e/praw/models/util.py#L167-L168
+
+        Given a shard index, only that shard's subreddits are scanned.
         """
         # Note that a seen set is not that useful here as PRAW keeps its own,
         # but as PRAW's stream may crash we still want to keep it around.
@@ -55,9 +215,18 @@ class Bot:
         # Additionally, we create a new reddit instance for the stream.
         # This is because requests.Session may not be thread safe, see
         # https://praw.readthedocs.io/en/v5.4.0/getting_started/multiple_instances.html
-        # We don't use requests.Session for any other API wrappers,
-        # so those should be thread safe - no state is mutated, only read.
-        reddit_instance = self.get_new_reddit()
+        # The other API wrappers keep a requests.Session per process and
+        # thread, so those are safe to share.
+        self.worker_started = time.monotonic()
+        if index is None:
+            worker, subreddit = thing_type, None
+        else:
+            worker = self.worker_name(thing_type, index)
+            subreddit = self.shards[index]
+        self.start_metrics(worker)
+        self.start_poster(worker)
+        reddit_instance = self.get_new_reddit(subreddit)
+        self.build_ledger(reddit_instance)
         if thing_type == "comment":
             content_factory = reddit_instance.get_comment_stream
         else:
@@ -65,15 +234,33 @@ class Bot:
 
         # We want the seen set to stay local to the method call / process,
         # as if this process is terminated while global state is being
-        # mutated, bad things may(?) occur.
-        seen = LimitedSet(300)
+        # mutated, bad things may(?) occur. A persisted seen set still
+        # remembers the things replayed by the new stream.
+        seen = self.new_seen(worker, 300)
+
+        # Things with maps are processed by worker threads, so a slow thing
+        # doesn't stop us reading the stream.
+        intake = None
+        if self.stream_workers > 0:
+            intake = IntakeQueue(self.intake_size)
+            metrics.REGISTRY.add_collector(
+                lambda: self.collect_intake(thing_type, intake))
+            for _ in range(self.stream_workers):
+                threading.Thread(target=self.work_stream,
+                                 args=(thing_type, intake, seen),
+                                 daemon=True).start()
 
         while True:
             try:
                 print("Starting", thing_type, "streaming.")
                 for thing in content_factory():
                     try:
-                        self.process_content(thing_type, thing, seen, reddit_instance)
+                        if intake is None:
+                            self.process_content(thing_type, thing, seen,
+                                                 reddit_instance)
+                        else:
+                            self.queue_content(thing_type, thing, seen,
+                                               reddit_instance, intake)
                     except Exception as e:
                         print("We caught an exception when processing a thing! It says:")
                         print(e)
@@ -85,62 +272,378 @@ class Bot:
                 print("Sleeping for 15 seconds.")
                 time.sleep(15)
 
+    def queue_content(self, thing_type, thing, seen, reddit_instance,
+                      intake):
+        """Queues a thing for the stream workers if it links any maps.
+
+        Things without maps are done with right away, and things with fewer
+        maps are processed first, so cheap things never wait behind
+        expensive ones.
+        """
+        if thing.id in seen:
+            return
+        found = self.find_maps(thing)
+        if not found:
+            self.process_content(thing_type, thing, seen, reddit_instance,
+                                 found)
+            return
+        intake.put(thing.id, len(found), (thing, found))
+
+    def work_stream(self, thing_type, intake, seen):
+        """Processes things queued by queue_content, forever."""
+        # PRAW isn't thread safe, so each worker needs its own instance, and
+        # things read from the stream are moved over to it.
+        reddit_instance = self.get_new_reddit()
+        while True:
+            thing_id, (thing, found), waited = intake.get()
+            metrics.REGISTRY.observe("intake_wait_seconds", waited,
+                                     stream=thing_type)
+            try:
+                thing = reddit_instance.adopt(thing)
+                self.process_content(thing_type, thing, seen,
+                                     reddit_instance, found)
+            except Exception as e:
+                print("We caught an exception when processing a thing! It says:")
+                print(e)
+                print("The {} in question was {}".format(thing_type, thing_id))
+            finally:
+                intake.done(thing_id)
+
+    def collect_intake(self, thing_type, intake):
+        stats = intake.stats()
+        labels = {"stream": thing_type}
+        return [("gauge", "intake_queue_depth", labels, stats["depth"]),
+                ("gauge", "intake_active", labels, stats["active"]),
+                ("gauge", "intake_oldest_age_seconds", labels,
+                 stats["oldest_age"])]
+
+    def process_content(self, thing_type, thing, seen, reddit_instance,
+                        found=None):
+        cur_id = thing.id
+        found = self.check_thing(thing_type, thing, seen, found)
+        if not found:
+            return
+        if reddit_instance.has_replied(thing):
+            self.replied_before(thing_type, thing, seen, cur_id)
+            return
+
+        if len(found) > MAX_MAPS:
+            comments = self.too_many_maps_comments()
+        elif self.stream_replies:
+            comments = self.stream_comments(thing_type, found)
+        else:
+            comments = self.make_comments(thing_type, found,
+                                          self.fetch_maps(found))
+        if self.check_reply(thing, cur_id, found):
+            self.record_replied(thing, seen, found,
+                                reddit_instance.reply(thing, comments))
 
-    def process_content(self, thing_type, thing, seen, reddit_instance):
+    def check_thing(self, thing_type, thing, seen, found=None):
+        """Returns the maps linked in a new thing, or None if there are none
+        or the thing was seen already."""
         if thing.id in seen:
-            return  # already reached up to here before
+            return None  # already reached up to here before
         cur_id = thing.id
-        found = list(h.compose(
-            reddit.get_html_from_thing,
-            parse.get_links_from_html,
-            h.mapf(parse.get_map_params),
-            h.truthies,
-            h.remove_dups
-        )(thing))
+        if found is None:
+            found = self.find_maps(thing)
+        self.record_thing(thing_type, found)
 
         if not found:
             # print("New", thing_type, thing.id, "with no maps.")
             if thing.id != cur_id:
                 print("thing id changed, not found")
-                return
+                return None
             seen.add(thing.id)
+            return None
+        return found
+
+    def replied_before(self, thing_type, thing, seen, cur_id):
+        """Marks a thing the bot has replied to before as seen."""
+        print("We've replied to", thing_type, thing.id, "before!")
+        if thing.id != cur_id:
+            print("thing id changed, has replied")
             return
-        if reddit_instance.has_replied(thing):
-            print("We've replied to", thing_type, thing.id, "before!")
-            if thing.id != cur_id:
-                print("thing id changed, has replied")
-                return
-            seen.add(thing.id)
-            return  # we reached here in a past instance of this bot
+        seen.add(thing.id)  # we reached here in a past instance of this bot
 
-        if len(found) > 300:
-            comments = ["Too many maps.\n\n" + self.formatter.footer]
+    def check_reply(self, thing, cur_id, found):
+        """Checks a thing can be replied to once its comments are made."""
+        if len(found) > MAX_MAPS:
             print("thing:", thing.id, "too many maps.")
-            if thing.id != cur_id:
-                print("thing id changed, too many maps")
-                return
-            reddit_instance.reply(thing, comments)
-            seen.add(thing.id)
+            kind = "too many maps"
         else:
-            map_info = list(map(self.osu.get_beatmap_info, found))
-            pp_info = list(map(self.tillerino.get_pp_info, map_info))
-            map_strings = list(map(self.formatter.format_map,
-                                    map_info, pp_info))
+            print("thing:", thing.id, "found:", found)
+            kind = "normal comment"
+        if thing.id != cur_id:
+            print("thing id changed,", kind)
+            return False
+        return True
+
+    def record_replied(self, thing, seen, found, replied):
+        """Marks a thing as seen once reply has returned True for it."""
+        if not replied:
+            return  # another worker holds a claim on it
+        if len(found) <= MAX_MAPS:
+            self.record_reply()
+        seen.add(thing.id)
+
+    def find_maps(self, thing):
+        """Returns a list of the unique maps linked in a thing."""
+        with metrics.REGISTRY.timer("stage_seconds", stage="html"):
+            raw_html = reddit.get_raw_html_from_thing(thing)
+        with metrics.REGISTRY.timer("stage_seconds", stage="parse"):
+            return list(h.compose(
+                parse.get_maps_from_raw_html,
+                h.remove_dups
+            )(raw_html))
+
+    def record_thing(self, thing_type, found):
+        if self.worker_started is not None:
+            # How quickly a (re)started worker gets going.
+            metrics.REGISTRY.set("first_thing_seconds",
+                                 time.monotonic() - self.worker_started)
+            self.worker_started = None
+        metrics.REGISTRY.inc("things_total", type=thing_type)
+        metrics.REGISTRY.observe("maps_per_thing", len(found),
+                                 buckets=metrics.COUNT_BUCKETS)
+
+    def record_reply(self):
+        """Records how long after starting the bot first replied to a map,
+        which is shorter when starting with a warm cache."""
+        if not self.replied_once:
+            self.replied_once = True
+            metrics.REGISTRY.set("first_reply_seconds",
+                                 time.monotonic() - self.started)
+
+    def make_comments(self, thing_type, found, fetched):
+        """Formats the comments replying to a thing given its maps' info."""
+        with metrics.REGISTRY.timer("stage_seconds", stage="format"):
+            map_strings = list(map(self.format_fetched, found, fetched))
             is_selfpost = thing_type == "submission"
             is_meme = (self.meme is not None and
-                        sum(self.meme in s for s in map_strings) > 1)
+                       sum(self.meme in s for s in map_strings) > 1)
 
-            comments = self.formatter.format_comments(map_strings,
-                                                        selfpost=is_selfpost,
-                                                        meme=is_meme)
-            print("thing:", thing.id, "found:", found)
-            if thing.id != cur_id:
-                print("thing id changed, normal comment")
-                return
-            reddit_instance.reply(thing, comments)
-            seen.add(thing.id)
+            return self.formatter.format_comments(map_strings,
+                                                  selfpost=is_selfpost,
+                                                  meme=is_meme)
+
+    def stream_comments(self, thing_type, found):
+        """Yields the comments replying to a thing as soon as each is full,
+        while the maps of later comments are still being fetched.
+
+        Whether the maps are a meme is decided from about a comment's worth
+        of the first maps, as the header has to be known by then.
+        """
+        deadline = self.new_deadline()
+        if self.fetch_workers <= 1 or len(found) <= 1:
+            fetched = (self.try_fetch_map(m, i // MAPS_PER_PRIORITY, deadline)
+                       for i, m in enumerate(found))
+        else:
+            fetched = (self.fetched_result(f, deadline) for f in
+                       self.submit_fetches(found, deadline))
+
+        first = []
+        length = 0
+        any_fetched = False
+        for map_tuple, result in zip(found, fetched):
+            first.append(self.format_fetched(map_tuple, result))
+            length += len(first[-1])
+            any_fetched = any_fetched or result is not None
+            if length >= self.formatter.char_limit:
+                break
+        if not any_fetched:
+            raise Exception("Couldn't fetch any of the first maps.")
+        map_strings = map(self.format_fetched, found[len(first):], fetched)
+        is_selfpost = thing_type == "submission"
+        is_meme = (self.meme is not None and
+                   sum(self.meme in s for s in first) > 1)
+
+        chunker = self.formatter.chunker(selfpost=is_selfpost, meme=is_meme)
+        for map_string in chain(first, map_strings):
+            yield from chunker.add(map_string)
+        yield from chunker.finish()
+
+    def too_many_maps_comments(self):
+        return ["Too many maps.\n\n" + self.formatter.footer]
+
+    def format_fetched(self, map_tuple, fetched):
+        """Formats a map given the result of fetching it."""
+        if fetched is None:
+            return self.formatter.format_unavailable(map_tuple)
+        return self.formatter.format_map(*fetched)
+
+    def new_deadline(self):
+        """Returns when fetching the maps of a thing starting now should
+        stop, or None if it never should."""
+        if self.thing_budget is None:
+            return None
+        return time.monotonic() + self.thing_budget
+
+    def fetch_map(self, map_tuple, priority=0, deadline=None):
+        """Returns a tuple of the osu! and Tillerino info of a map.
+
+        Requests time out at the deadline, and pp info is left out if
+        Tillerino doesn't answer by then.
+        """
+        with metrics.REGISTRY.timer("stage_seconds", stage="osu_fetch"):
+            map_info = self.osu.get_beatmap_info(map_tuple, priority,
+                                                 remaining(deadline))
+        try:
+            within = remaining(deadline)
+        except OutOfTime:
+            return map_info, {}
+        with metrics.REGISTRY.timer("stage_seconds", stage="tillerino_fetch"):
+            pp_info = self.tillerino.get_pp_info(map_info, priority, within)
+        return map_info, pp_info
+
+    def try_fetch_map(self, map_tuple, priority=0, deadline=None):
+        """Returns what fetch_map does, or None if it fails."""
+        try:
+            return self.fetch_map(map_tuple, priority, deadline)
+        except Exception as e:
+            self.record_unavailable(e)
+            return None
+
+    def fetched_result(self, future, deadline=None):
+        """Returns the result of a fetch_map future, or None if it failed
+        or isn't done by the deadline."""
+        timeout = None
+        if deadline is not None:
+            timeout = max(deadline + DEADLINE_GRACE - time.monotonic(), 0)
+        wait([future], timeout)
+        if not future.done():
+            self.record_unavailable(OutOfTime())
+            return None
+        if future.exception() is not None:
+            self.record_unavailable(future.exception())
+            return None
+        return future.result()
+
+    def record_unavailable(self, e):
+        timeout = isinstance(e, (OutOfTime, ratelimit.RateLimitTimeout))
+        reason = "timeout" if timeout else type(e).__name__
+        if reason != "timeout":
+            print("We couldn't fetch a map:", e)
+        metrics.REGISTRY.inc("maps_unavailable_total", reason=reason)
+
+    def fetch_maps(self, found):
+        """Fetches the info of many maps, keeping the order of found.
+
+        With more than one fetch worker, maps are fetched concurrently and
+        each map's pp info is requested as soon as its osu! info arrives.
+        The first maps of a thing get priority when rate limited.
+
+        Maps which fail or aren't fetched within the thing's time budget are
+        None, unless no map could be fetched, which raises an exception.
+        """
+        deadline = self.new_deadline()
+        if self.fetch_workers <= 1 or len(found) <= 1:
+            out = [None] * len(found)
+            for i in self.fetch_order(found):
+                out[i] = self.try_fetch_map(found[i], i // MAPS_PER_PRIORITY,
+                                            deadline)
+            check_fetched(out)
+            return out
+        return self.collect_fetched(self.submit_fetches(found, deadline),
+                                    deadline)
+
+    def collect_fetched(self, futures, deadline=None):
+        """Returns the results of fetch_map futures, as fetch_maps does."""
+        out = [self.fetched_result(f, deadline) for f in futures]
+        check_fetched(out)
+        return out
+
+    def fetch_order(self, found):
+        """Returns the indices of found in the order to fetch them in.
+
+        Within each group of MAPS_PER_PRIORITY maps, sets and difficulties
+        of sets we know of come first. Difficulties of unknown sets may then
+        be sliced out of the responses for the sets linked alongside them
+        instead of being requested on their own.
+        """
+        return sorted(range(len(found)),
+                      key=lambda i: (i // MAPS_PER_PRIORITY,
+                                     not self.osu.knows_set(found[i])))
+
+    def submit_fetches(self, found, deadline=None):
+        """Starts fetching many maps in the fetch pool, returning a future
+        for each in the order of found."""
+        pool = self.get_fetch_pool()
+        futures = [None] * len(found)
+        sets = []
+        for i in self.fetch_order(found):
+            priority = i // MAPS_PER_PRIORITY
+            if self.osu.knows_set(found[i]):
+                futures[i] = pool.submit(self.fetch_map, found[i], priority,
+                                         deadline)
+                if found[i][0] == "s":
+                    sets.append(futures[i])
+            else:
+                # Only sets linked up to this map's group are waited on, so
+                # the first maps aren't held up by the last. They were
+                # submitted first, so they can't be stuck behind the workers
+                # waiting on them.
+                futures[i] = pool.submit(self.fetch_map_after, list(sets),
+                                         found[i], priority, deadline)
+        return futures
+
+    def fetch_map_after(self, futures, map_tuple, priority=0, deadline=None):
+        """Fetches a map once futures are done, successfully or not."""
+        wait(futures)
+        return self.fetch_map(map_tuple, priority, deadline)
+
+    def get_fetch_pool(self):
+        # Threads do not survive a fork, so each process gets its own pool.
+        if self._fetch_pool is None or self._fetch_pool_pid != os.getpid():
+            self._fetch_pool = ThreadPoolExecutor(self.fetch_workers)
+            self._fetch_pool_pid = os.getpid()
+        return self._fetch_pool
+
+    def collect_metrics(self):
+        """Returns the stats of the API wrappers and caches as metrics."""
+        out = []
+        for cache_obj in [self.osu.cache, self.osu.set_ids,
+                          self.tillerino.cache, self.formatter.cache]:
+            stats = cache_obj.stats()
+            labels = {"cache": cache_obj.name}
+            for key in ["hits", "misses", "evictions"]:
+                out.append(("counter", "cache_" + key + "_total", labels,
+                            stats[key]))
+            out.append(("gauge", "cache_size", labels, stats["size"]))
+        for api, wrapper in [("osu", self.osu), ("tillerino", self.tillerino)]:
+            labels = {"api": api}
+            session = wrapper.session.stats()
+            out.append(("counter", "http_connections_opened_total", labels,
+                        session["connections_opened"]))
+            out.append(("counter", "http_connections_reused_total", labels,
+                        session["connections_reused"]))
+            if wrapper.limiter is not None:
+                for key, value in wrapper.limiter.stats().items():
+                    out.append(("gauge", "ratelimit_" + key, labels, value))
+            breaker = wrapper.breaker.stats()
+            out.append(("gauge", "circuit_state", labels, breaker["state"]))
+            out.append(("counter", "circuit_opened_total", labels,
+                        breaker["opened"]))
+            out.append(("counter", "circuit_rejected_total", labels,
+                        breaker["rejected"]))
+        return out
+
+    def start_metrics(self, worker, combined=False):
+        """Starts writing this process' metrics, if enabled."""
+        if self.metrics_dir:
+            metrics.start_writer(self.metrics_dir, worker,
+                                 self.metrics_interval, combined)
+
+    def export_metrics(self):
+        if self.metrics_dir:
+            try:
+                metrics.export(self.metrics_dir)
+            except Exception as e:
+                print("Couldn't export metrics:", e)
 
     def run_scan_loop(self):
+        self.start_metrics("loop", combined=True)
+        self.start_poster("loop")
+        self.build_ledger(self.reddit)
         while True:
             try:
                 self.scan_content(
@@ -164,33 +667,411 @@ class Bot:
                 time.sleep(15)
                 continue
 
+    def api_caches(self):
+        """Returns the caches of API responses."""
+        return [self.osu.cache, self.osu.set_ids, self.tillerino.cache]
+
+    def dump_caches(self, path):
+        count = cache.dump_snapshot(self.api_caches(), path)
+        print("Dumped", count, "cache entries to", path)
+
+    def load_caches(self, path):
+        loaded = cache.load_snapshot(self.api_caches(), path)
+        for name, count in loaded.items():
+            print("Loaded", count, "entries into the", name, "cache.")
+
+    def share_caches(self):
+        """Prepares the osu! and Tillerino caches to be shared by workers.
+
+        Without a configured cache file, a temporary one is used for as long
+        as the bot runs, so workers still share their caches and keep them
+        across restarts.
+        """
+        if self.db is None:
+            tmp_dir = tempfile.mkdtemp(prefix="beatmaplinker-")
+            atexit.register(shutil.rmtree, tmp_dir, True)
+            self.db = db.Database(os.path.join(tmp_dir, "cache.sqlite3"))
+            self.osu.cache.attach(self.db)
+            self.osu.set_ids.attach(self.db)
+            self.tillerino.cache.attach(self.db)
+        self.osu.cache.purge()
+        self.tillerino.cache.purge()
+
     def run_scan_stream(self):
+        """Runs a comment and a submission worker process for each shard.
+
+        Workers are forked from this process, which has already imported
+        everything and compiled the templates. A worker which stops is
+        restarted on its own, waiting longer each time it stops soon after
+        starting.
+        """
+        self.share_caches()
+        supervisor = Supervisor(self.restart_delay, self.max_restart_delay)
+        for index in self.shards:
+            for thing_type in ["comment", "submission"]:
+                supervisor.add(self.worker_name(thing_type, index),
+                               self.scan_content_stream, (thing_type, index))
+
+        def tick():
+            if self.metrics_dir:
+                os.makedirs(self.metrics_dir, exist_ok=True)
+                supervisor.registry.write(
+                    os.path.join(self.metrics_dir, "supervisor.json"))
+                self.export_metrics()
+
+        try:
+            supervisor.run(self.metrics_interval if self.metrics_dir
+                           else None, tick)
+        finally:
+            supervisor.terminate()
+
+    def use_responses(self, path, record=False):
+        """Answers API requests from responses recorded in a file instead of
+        the APIs, or with record, records the APIs' responses into it."""
+        store = batch.ResponseStore(db.Database(path))
+        for api, wrapper in [("osu", self.osu), ("tillerino", self.tillerino)]:
+            wrapper.session = batch.RecordedSession(
+                store, api, wrapper.session if record else None)
+            if not record:
+                wrapper.limiter = None
+        if record:
+            return
+        # Whether a difficulty was requested while recording, or sliced out
+        # of its set, depended on which sets were known at the time. Knowing
+        # every recorded set, difficulties are always sliced out of them.
+        set_ids = []
+        for params, status, body in store.iter_responses("osu"):
+            if "s" in params and status == 200:
+                set_ids.extend(((d["beatmap_id"],), float("inf"),
+                                d["beatmapset_id"]) for d in json.loads(body))
+        self.osu.set_ids.load(set_ids)
+
+    def run_batch(self, dump_path, output_path, responses=None, record=False,
+                  processes=1, chunk_size=100, window=4, verbose=False):
+        """Replays a dump of reddit things through process_content, writing
+        the replies to a file as JSON lines instead of posting them.
+
+        The dump is read a chunk of things at a time and processed by a pool
+        of processes forked from this one, with at most window chunks per
+        process waiting, so memory use doesn't grow with the dump. Maps are
+        fetched through the caches as usual, and with a responses file, as
+        use_responses does. Returns a dict of counts.
+        """
+        stages = {"read": 0.0, "write": 0.0}
+        counts = {"things": 0, "replies": 0, "failed": 0, "invalid": 0}
+        caches = {}
+
+        def read():
+            start = time.perf_counter()
+            for line in batch.read_dump(dump_path):
+                counts["things"] += 1
+                # find_maps would find nothing in these, so they aren't
+                # worth sending to the pool.
+                if "ppy.sh" not in line:
+                    continue
+                stages["read"] += time.perf_counter() - start
+                yield line
+                start = time.perf_counter()
+            stages["read"] += time.perf_counter() - start
+
+        started = time.perf_counter()
+        if processes > 1:
+            self.share_caches()
+        if responses:
+            self.use_responses(responses, record)
+        pool = None
+        if processes > 1:
+            pool = ProcessPoolExecutor(processes, mp.get_context("fork"),
+                                       initializer=batch.init_worker,
+                                       initargs=(self.process_batch,))
+            results = batch.windowed(
+                lambda chunk: pool.submit(batch.run_worker, chunk),
+                batch.chunks(read(), chunk_size), processes * window)
+        else:
+            results = map(self.process_batch,
+                          batch.chunks(read(), chunk_size))
+
+        try:
+            with open(output_path, "w", encoding="utf8") as out, \
+                    open(os.devnull, "w") as devnull, \
+                    contextlib.redirect_stdout(sys.stdout if verbose
+                                               else devnull):
+                for result in results:
+                    start = time.perf_counter()
+                    for record in result["records"]:
+                        out.write(json.dumps(record) + "\n")
+                        counts["failed" if "error" in record
+                               else "replies"] += 1
+                    stages["write"] += time.perf_counter() - start
+                    counts["invalid"] += result["invalid"]
+                    for stage, seconds in result["stages"].items():
+                        stages[stage] = stages.get(stage, 0.0) + seconds
+                    for name, (hits, misses) in result["caches"].items():
+                        total = caches.get(name, (0, 0))
+                        caches[name] = (total[0] + hits, total[1] + misses)
+        finally:
+            if pool is not None:
+                pool.shutdown(cancel_futures=True)
+
+        report_batch(counts, time.perf_counter() - started, stages, caches)
+        return counts
+
+    def process_batch(self, lines):
+        """Processes a chunk of dumped things as process_content does.
+
+        Returns the records of the replies made and of things which failed,
+        with how long each stage took and the lookups of each cache.
+        """
+        batch_reddit = batch.BatchReddit(self.ledger)
+        cache_objs = self.api_caches() + [self.formatter.cache]
+        stages_before = metrics.REGISTRY.sums("stage_seconds")
+        caches_before = {c.name: c.stats() for c in cache_objs}
+        invalid = 0
+        for line in lines:
+            try:
+                with metrics.REGISTRY.timer("stage_seconds", stage="decode"):
+                    thing_type, thing = batch.make_thing(json.loads(line))
+            except (ValueError, KeyError, TypeError):
+                invalid += 1
+                continue
+            try:
+                self.process_content(thing_type, thing, set(), batch_reddit)
+            except Exception as e:
+                batch_reddit.records.append({"id": thing.id,
+                                             "fullname": batch.fullname(thing),
+                                             "error": str(e)})
+
+        stages = {}
+        for labels, total in metrics.REGISTRY.sums("stage_seconds").items():
+            stages[dict(labels)["stage"]] = (total -
+                                             stages_before.get(labels, 0.0))
+        caches = {}
+        for cache_obj in cache_objs:
+            before, after = caches_before[cache_obj.name], cache_obj.stats()
+            caches[cache_obj.name] = (after["hits"] - before["hits"],
+                                      after["misses"] - before["misses"])
+        return {"records": batch_reddit.records, "invalid": invalid,
+                "stages": stages, "caches": caches}
+
+    def run_scan_async(self):
+        """Runs the bot in a single process on an asyncio event loop.
+
+        Comment and submission intake, processing and replying run as tasks
+        sharing one reddit instance and the in-memory caches. A task that
+        fails is restarted on its own.
+        """
+        try:
+            asyncio.run(self.scan_async())
+        except KeyboardInterrupt:
+            print("Stopping the bot.")
+            sys.exit()
+
+    async def scan_async(self):
+        # PRAW may not be thread safe, so every reddit call is made from the
+        # same thread.
+        reddit_executor = ThreadPoolExecutor(1)
+        loop = asyncio.get_running_loop()
+        self.start_metrics("async", combined=True)
+        self.start_poster("async")
+        if self.stream_replies and self.outbox is None:
+            print("stream_replies needs outbox_path in the async runtime,",
+                  "so replies are posted once every map is fetched.")
+        await loop.run_in_executor(reddit_executor, self.build_ledger,
+                                   self.reddit)
+
+        things = asyncio.Queue(self.async_workers)
+        replies = asyncio.Queue()
+        seen_comments = self.new_seen("comment", 300)
+        seen_submissions = self.new_seen("submission", 300)
+
+        tasks = [
+            self.keep_running("comment intake", lambda: self.intake_async(
+                "comment", self.reddit.get_comment_stream, seen_comments,
+                things, reddit_executor)),
+            self.keep_running("submission intake", lambda: self.intake_async(
+                "submission", self.reddit.get_submission_stream,
+                seen_submissions, things, reddit_executor)),
+            self.keep_running("replying", lambda: self.reply_async(
+                replies, reddit_executor))
+        ]
+        for i in range(self.async_workers):
+            tasks.append(self.keep_running(
+                "processing {}".format(i),
+                lambda: self.process_async(things, replies, reddit_executor)))
+        await asyncio.gather(*tasks)
+
+    async def keep_running(self, name, coro_factory):
+        """Runs a task forever, restarting it if it fails."""
         while True:
-            comment_process = mp.Process(
-                target=self.scan_content_stream,
-                args=("comment",),
-            )
-            comment_process.start()
-
-            submission_process = mp.Process(
-                target=self.scan_content_stream,
-                args=("submission",),
-            )
-            submission_process.start()
-
-            mpc.wait([
-                comment_process.sentinel,
-                submission_process.sentinel
-            ])
-
-            print("Something went wrong - restarting processes.")
-            submission_process.terminate()
-            comment_process.terminate()
-            print("Sleeping for 15 seconds.")
-            time.sleep(15)
+            try:
+                await coro_factory()
+            except Exception as e:
+                print("The", name, "task caught an exception:")
+                print(e)
+                print("Restarting it in 15 seconds.")
+                await asyncio.sleep(15)
 
+    async def intake_async(self, thing_type, content_factory, seen, things,
+                           reddit_executor):
+        loop = asyncio.get_running_loop()
+        print("Starting", thing_type, "streaming.")
+        # Rather than let the stream sleep in the reddit thread when there's
+        # nothing new, we back off here to keep that thread free.
+        stream = content_factory(pause_after=0)
+        delay = 0
+        while True:
+            thing = await loop.run_in_executor(reddit_executor, next, stream)
+            if thing is None:
+                delay = min(2 * delay or 1, 16)
+                await asyncio.sleep(delay)
+                continue
+            delay = 0
+            if thing.id not in seen:
+                await things.put((thing_type, thing, seen))
+
+    async def process_async(self, things, replies, reddit_executor):
+        while True:
+            thing_type, thing, seen = await things.get()
+            try:
+                await self.process_content_async(thing_type, thing, seen,
+                                                 replies, reddit_executor)
+            except Exception as e:
+                print("We caught an exception when processing a thing! It says:")
+                print(e)
+                print("The {} in question was {}".format(thing_type, thing.id))
+
+    async def process_content_async(self, thing_type, thing, seen, replies,
+                                    reddit_executor):
+        """Does what process_content does, queueing replies for reply_async."""
+        loop = asyncio.get_running_loop()
+        cur_id = thing.id
+        found = self.check_thing(thing_type, thing, seen)
+        if not found:
+            return
+        if await loop.run_in_executor(reddit_executor,
+                                      self.reddit.has_replied, thing):
+            self.replied_before(thing_type, thing, seen, cur_id)
+            return
+
+        # Replies are only queued in the outbox, so streamed comments can be
+        # made as they're queued without holding up the reddit thread.
+        streamed = self.stream_replies and self.outbox is not None
+        if len(found) > MAX_MAPS:
+            comments = self.too_many_maps_comments()
+        elif streamed:
+            comments = self.stream_comments(thing_type, found)
+        else:
+            deadline = self.new_deadline()
+            futures = self.submit_fetches(found, deadline)
+            timeout = None
+            if deadline is not None:
+                timeout = self.thing_budget + DEADLINE_GRACE
+            await asyncio.wait(list(map(asyncio.wrap_future, futures)),
+                               timeout=timeout)
+            comments = self.make_comments(
+                thing_type, found, self.collect_fetched(futures, deadline))
+        if not self.check_reply(thing, cur_id, found):
+            return
+        if streamed and len(found) <= MAX_MAPS:
+            self.record_replied(thing, seen, found, await loop.run_in_executor(
+                None, self.reddit.reply, thing, comments))
+        else:
+            await replies.put((thing, found, comments, seen))
+
+    async def reply_async(self, replies, reddit_executor):
+        loop = asyncio.get_running_loop()
+        while True:
+            thing, found, comments, seen = await replies.get()
+            try:
+                self.record_replied(thing, seen, found,
+                                    await loop.run_in_executor(
+                                        reddit_executor, self.reddit.reply,
+                                        thing, comments))
+            except Exception as e:
+                print("We caught an exception when replying! It says:")
+                print(e)
+                print("The thing in question was", thing.id)
+
+
+def remaining(deadline):
+    """Returns the seconds left until a deadline, raising OutOfTime if there
+    are none, or None if there's no deadline."""
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise OutOfTime()
+    return left
+
+
+def check_fetched(fetched):
+    """Raises an exception if none of the maps of a thing were fetched, as
+    a reply of only unavailable maps is no use."""
+    if fetched and all(result is None for result in fetched):
+        raise Exception("Couldn't fetch any of the maps.")
+
+
+def report_batch(counts, elapsed, stages, caches):
+    """Prints the throughput of a batch run, the time spent in each stage
+    and each cache's hit rate.
+
+    Stages run by the pool are summed over its processes and fetch threads,
+    so they may add up to more than the time taken.
+    """
+    print("Processed {things} things in {:.1f}s ({:.1f} things/s): "
+          "{replies} replies, {failed} failed, {invalid} invalid.".format(
+              elapsed, counts["things"] / elapsed if elapsed else 0.0,
+              **counts))
+    total = sum(stages.values())
+    print("{:<16} {:>10} {:>7}".format("stage", "seconds", "share"))
+    for stage, seconds in sorted(stages.items(), key=lambda s: -s[1]):
+        print("{:<16} {:>10.3f} {:>7.1%}".format(
+            stage, seconds, seconds / total if total else 0.0))
+    for name, (hits, misses) in sorted(caches.items()):
+        lookups = hits + misses
+        print("{} cache: {} lookups, {:.1%} hits".format(
+            name, lookups, hits / lookups if lookups else 0.0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Runs BeatmapLinker.")
+    subparsers = parser.add_subparsers(dest="command")
+    run_parser = subparsers.add_parser("run", help="run the bot (default)")
+    run_parser.add_argument("--load-cache", metavar="FILE",
+                            help="load a cache snapshot before starting")
+    dump_parser = subparsers.add_parser(
+        "dump-cache", help="write the API response caches to a snapshot")
+    dump_parser.add_argument("file")
+    load_parser = subparsers.add_parser(
+        "load-cache", help="load a snapshot into the API response caches")
+    load_parser.add_argument("file")
+    batch_parser = subparsers.add_parser(
+        "batch", help="replay a dump of reddit things, writing the replies "
+                      "to a file instead of reddit")
+    batch_parser.add_argument("dump", help="comments and submissions as "
+                                           "JSON lines, optionally gzipped")
+    batch_parser.add_argument("output", help="file to write replies to")
+    batch_parser.add_argument("--responses", metavar="FILE",
+                              help="answer API requests from responses "
+                                   "recorded in FILE, to run offline")
+    batch_parser.add_argument("--record", action="store_true",
+                              help="make API requests, recording the "
+                                   "responses into --responses")
+    batch_parser.add_argument("--processes", type=int,
+                              default=os.cpu_count(),
+                              help="processes parsing and formatting things")
+    batch_parser.add_argument("--chunk-size", type=int, default=100,
+                              help="things sent to a process at a time")
+    batch_parser.add_argument("--window", type=int, default=4,
+                              help="chunks waiting per process")
+    batch_parser.add_argument("--load-cache", metavar="FILE",
+                              help="load a cache snapshot before starting")
+    batch_parser.add_argument("--verbose", action="store_true",
+                              help="print what the bot prints per thing")
+    args = parser.parse_args(argv)
+    if args.command == "batch" and args.record and not args.responses:
+        parser.error("--record needs --responses")
 
-def main():
     config = ConfigParser()
     with open("config_default.ini", encoding="utf8") as c:
         config.read_file(c)
@@ -208,7 +1089,39 @@ def main():
     replacements.read("replacements.ini", encoding="utf8")
 
     bot = Bot(config, replacements)
-    bot.run_scan_stream()
+    if args.command == "dump-cache":
+        if bot.db is None:
+            print("Set path under the cache section to dump a snapshot of.")
+            sys.exit(1)
+        bot.dump_caches(args.file)
+        return
+    if args.command == "load-cache":
+        if bot.db is None:
+            print("Set path under the cache section to load a snapshot into.")
+            sys.exit(1)
+        bot.load_caches(args.file)
+        return
+
+    if args.command == "batch":
+        shared = args.processes > 1
+    else:
+        shared = bot.runtime == "stream"
+    if getattr(args, "load_cache", None):
+        if bot.db is None and shared:
+            # Workers share a temporary cache which doesn't exist yet.
+            bot.share_caches()
+        bot.load_caches(args.load_cache)
+    if args.command == "batch":
+        bot.run_batch(args.dump, args.output, args.responses, args.record,
+                      args.processes, args.chunk_size, args.window,
+                      args.verbose)
+        return
+    if bot.runtime == "async":
+        bot.run_scan_async()
+    elif bot.runtime == "loop":
+        bot.run_scan_loop()
+    else:
+        bot.run_scan_stream()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,24 @@
+import threading
+
+from beatmaplinker import ratelimit
+from beatmaplinker.ratelimit import TokenBucket
+
+
+def test_waiters_beyond_slots_free_them(monkeypatch):
+    monkeypatch.setattr(ratelimit, "MAX_WAITERS", 2)
+    bucket = TokenBucket(rate=200, burst=1)
+    bucket.acquire()  # empty the bucket so every request waits
+
+    threads = [threading.Thread(target=bucket.acquire, args=(i % 4,),
+                               daemon=True)
+               for i in range(6)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(5)
+
+    assert not any(thread.is_alive() for thread in threads)
+    assert list(bucket.waiter_pids) == [0, 0]
+    assert bucket.stats()["queue_depth"] == 0
+    # No slot left behind holds up less urgent requests.
+    assert bucket.acquire(3, timeout=1) is not None